@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Measure DICOM archive packing throughput and size across transfer syntaxes and compression policies.
+
+Usage: python -m benchmarks.dicom_compression [--instances 50 200] [--rows 512]
+"""
+import argparse
+import array
+import concurrent.futures
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import pydicom
+import pydicom.encaps
+from pydicom.uid import ExplicitVRLittleEndian, JPEG2000Lossless, JPEGBaseline8Bit, RLELossless, generate_uid
+
+import run
+
+
+TRANSFER_SYNTAXES = [
+    ('explicit-le', ExplicitVRLittleEndian),
+    ('jpeg-baseline', JPEGBaseline8Bit),
+    ('jpeg2000', JPEG2000Lossless),
+    ('rle', RLELossless),
+]
+
+
+def synthetic_frame(rows):
+    # smooth gradient with a little noise, compresses roughly like a real MR/CT slice
+    rand = random.Random(rows)
+    return array.array('H', (((x * 7 + y * 3) & 0x3ff) + rand.randrange(16)
+                             for y in range(rows) for x in range(rows))).tobytes()
+
+
+def write_series(series_dir, transfer_syntax, instances, rows, frame):
+    series_uid = generate_uid()
+    for i in range(instances):
+        ds = pydicom.Dataset()
+        ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        ds.SOPInstanceUID = generate_uid()
+        ds.StudyInstanceUID = '1.2.3'
+        ds.SeriesInstanceUID = series_uid
+        ds.PatientID = 'BENCH'
+        ds.StudyDate = ds.AcquisitionDate = '20190101'
+        ds.StudyTime = ds.AcquisitionTime = '120000'
+        ds.Rows = ds.Columns = rows
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.SamplesPerPixel = 1
+        ds.PixelRepresentation = 0
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        if transfer_syntax == ExplicitVRLittleEndian:
+            ds.PixelData = frame
+        else:
+            # already compressed pixel data doesn't deflate, random bytes behave the same
+            ds.PixelData = pydicom.encaps.encapsulate([os.urandom(len(frame) // 3)])
+        ds['PixelData'].VR = 'OW' if transfer_syntax == ExplicitVRLittleEndian else 'OB'
+        ds.file_meta = pydicom.dataset.FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = transfer_syntax
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        save_dicom(os.path.join(series_dir, ds.SOPInstanceUID), ds)
+
+
+def save_dicom(fp, ds):
+    # pydicom 2 (the last major version for python 3.7) encodes by the dataset's own flags, pydicom 3 by the
+    # file meta transfer syntax and deprecates the pydicom 2 arguments
+    if int(pydicom.__version__.split('.')[0]) < 3:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = ds.file_meta.TransferSyntaxUID == pydicom.uid.ImplicitVRLittleEndian
+        pydicom.dcmwrite(fp, ds, write_like_original=False)
+    else:
+        pydicom.dcmwrite(fp, ds, enforce_file_format=True)
+
+
+def bench(source_dir, mode, level, workers):
+    with tempfile.TemporaryDirectory() as tempdir:
+        series_dir = os.path.join(tempdir, 'series')
+        shutil.copytree(source_dir, series_dir)
+        input_size = sum(os.path.getsize(os.path.join(series_dir, fn)) for fn in os.listdir(series_dir))
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        compressor = run.MemberCompressor(mode=mode, level=level, executor=executor)
+        start = time.perf_counter()
+        archives = run.pkg_series(series_dir, compressor=compressor, timezone=run.DEFAULT_TZ, map_key='PatientID')
+        elapsed = time.perf_counter() - start
+        if executor is not None:
+            executor.shutdown()
+        output_size = sum(os.path.getsize(archive.path) for archive in archives)
+    return input_size, output_size, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--instances', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--rows', type=int, default=512)
+    args = parser.parse_args()
+
+    cpus = os.cpu_count() or 1
+    policies = [('deflate', 6, 1), ('auto', 6, 1), ('auto', 1, 1), ('auto', 6, cpus)]
+    frame = synthetic_frame(args.rows)
+
+    print('{:<14} {:>9} {:>10} {:<16} {:>9} {:>7} {:>9}'.format(
+        'syntax', 'instances', 'input MB', 'policy', 'output MB', 'ratio', 'MB/s'))
+    for label, transfer_syntax in TRANSFER_SYNTAXES:
+        for instances in args.instances:
+            with tempfile.TemporaryDirectory() as source_dir:
+                write_series(source_dir, transfer_syntax, instances, args.rows, frame)
+                for mode, level, workers in policies:
+                    input_size, output_size, elapsed = bench(source_dir, mode, level, workers)
+                    print('{:<14} {:>9} {:>10.1f} {:<16} {:>9.1f} {:>7.2f} {:>9.1f}'.format(
+                        label, instances, input_size / 1e6, '{}/{}/x{}'.format(mode, level, workers),
+                        output_size / 1e6, output_size / input_size, input_size / 1e6 / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+"""Drive run.main() end to end against local stand-ins of DICOMweb, HL7v2, FHIR and the Flywheel API.
+
+Usage: python -m benchmarks.end_to_end [--patients 10] [--series 20] [--instances 50] [--hl7s 200] [--fhirs 200]
+                                       [--latency 0.01] [--error-rate 0.01] [--config '{"dicom_upload_mode": "file"}']
+"""
+import argparse
+import base64
+import collections
+import io
+import json
+import logging
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import pydicom
+import requests
+from dicomweb_client.api import DICOMwebClient
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+import run
+from benchmarks.dicom_compression import save_dicom
+
+
+BOUNDARY = 'benchmark-boundary'
+
+
+class SyntheticData:
+    def __init__(self, patients, series, instances, rows, hl7s, fhirs):
+        self.rows = rows
+        self.patient_ids = ['MRN-{:05d}'.format(i) for i in range(patients)]
+        self.study_uids = [generate_uid() for _ in range(patients)]
+        self.series = collections.OrderedDict()
+        for i in range(series):
+            patient = i % patients
+            self.series[generate_uid()] = (self.study_uids[patient], self.patient_ids[patient])
+        self.instances = {series_uid: [self.dicom_instance(study_uid, series_uid, patient_id, n, rows)
+                                       for n in range(instances)]
+                          for series_uid, (study_uid, patient_id) in self.series.items()}
+        self.hl7s = collections.OrderedDict(
+            (base64.urlsafe_b64encode(os.urandom(24)).decode(), self.hl7_message(n, random.choice(self.patient_ids)))
+            for n in range(hl7s))
+        self.fhir_patients = {'pat-{:05d}'.format(i): self.fhir_patient('pat-{:05d}'.format(i), patient_id)
+                              for i, patient_id in enumerate(self.patient_ids)}
+        self.fhirs = collections.OrderedDict(
+            ('Observation/obs-{:06d}'.format(n), self.fhir_observation(n, random.choice(list(self.fhir_patients))))
+            for n in range(fhirs))
+
+    @property
+    def object_references(self):
+        return {
+            'dicoms': self.study_uids,
+            'hl7s': list(self.hl7s),
+            'fhirs': ['Patient/' + patient for patient in self.fhir_patients] + list(self.fhirs),
+        }
+
+    @staticmethod
+    def dicom_instance(study_uid, series_uid, patient_id, number, rows):
+        ds = pydicom.Dataset()
+        ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        ds.SOPInstanceUID = generate_uid()
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.PatientID = patient_id
+        ds.PatientName = 'Lastname^Firstname'
+        ds.PatientBirthDate = '19720417'
+        ds.Modality = 'MR'
+        ds.SeriesDescription = 'T1w Structural'
+        ds.StudyDate = ds.AcquisitionDate = '20190101'
+        ds.StudyTime = ds.AcquisitionTime = '120000'
+        ds.InstanceNumber = number + 1
+        ds.Rows = ds.Columns = rows
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.SamplesPerPixel = 1
+        ds.PixelRepresentation = 0
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.PixelData = bytes((x * 7 + number) & 0xff for x in range(rows * rows * 2))
+        ds['PixelData'].VR = 'OW'
+        ds.file_meta = pydicom.dataset.FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        buf = io.BytesIO()
+        save_dicom(buf, ds)
+        return buf.getvalue()
+
+    @staticmethod
+    def hl7_message(number, patient_id):
+        return {
+            'messageType': 'ORU',
+            'sendTime': '2019-01-01T12:00:00Z',
+            'parsedData': {'segments': [
+                {'segmentId': 'MSH', 'fields': {'9': 'CTRL{:06d}'.format(number)}},
+                {'segmentId': 'PID', 'fields': {'3.1': patient_id, '5.1': 'Firstname', '5.2': 'Lastname',
+                                                '7': '19720417', '8': 'F'}},
+            ]},
+            'data': base64.b64encode(os.urandom(512)).decode(),
+        }
+
+    @staticmethod
+    def fhir_patient(resource_id, patient_id):
+        return {
+            'resourceType': 'Patient',
+            'id': resource_id,
+            'meta': {'lastUpdated': '2019-07-02T13:17:36.759627+0000'},
+            'gender': 'female',
+            'birthDate': '1972-04-17',
+            'name': [{'family': 'Lastname', 'given': ['Firstname']}],
+            'identifier': [{'type': {'coding': [{'code': 'MR'}]}, 'value': patient_id}],
+        }
+
+    @staticmethod
+    def fhir_observation(number, patient):
+        return {
+            'resourceType': 'Observation',
+            'id': 'obs-{:06d}'.format(number),
+            'meta': {'lastUpdated': '2019-07-02T13:17:37.265024+0000'},
+            'subject': {'reference': 'Patient/' + patient},
+            'code': {'coding': [{'code': '15074-8', 'display': 'Glucose [Moles/volume] in Blood',
+                                 'system': 'http://loinc.org'}]},
+            'valueQuantity': {'unit': 'mmol/l', 'value': 6.3},
+        }
+
+    def get_fhir(self, ref):
+        if ref.startswith('Patient/'):
+            return self.fhir_patients.get(ref.split('/')[1])
+        return self.fhirs.get(ref)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data, latency=0.0, error_rate=0.0):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.data = data
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # clients dropping idle keep-alive connections are not errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        ('GET', re.compile(r'/api/projects/([^/]+)$'), 'project'),
+        ('GET', re.compile(r'/api/projects/([^/]+)/subjects$'), 'subjects'),
+        ('GET', re.compile(r'/api/users/self/tokens/([^/]+)$'), 'token'),
+        ('GET', re.compile(r'/api/acquisitions$'), 'acquisitions'),
+        ('POST', re.compile(r'/api/subjects/master-code$'), 'master_code'),
+        ('POST', re.compile(r'/api/upload/(uid|label)$'), 'upload'),
+        ('GET', re.compile(r'/dicomWeb/series$'), 'qido'),
+        ('GET', re.compile(r'/dicomWeb/studies/([^/]+)/series/([^/]+)$'), 'wado'),
+        ('GET', re.compile(r'/dicomWeb/studies/([^/]+)/series/([^/]+)/instances$'), 'qido_instances'),
+        ('GET', re.compile(r'/hl7/messages/([^/]+)$'), 'hl7'),
+        ('GET', re.compile(r'/fhir/(\w+/[^/]+)$'), 'fhir_read'),
+        ('POST', re.compile(r'/fhir$'), 'fhir_batch'),
+    ]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        body = self.read_body()
+        for route_method, pattern, name in self.ROUTES:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.respond(404, b'{}')
+        server = self.server
+        with server.lock:
+            server.requests[name] += 1
+            server.bytes_in += len(body)
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        if name != 'token' and random.random() < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            return self.respond(503, b'{}', headers={'Retry-After': '0'})
+        getattr(self, 'handle_' + name)(body, parse_qs(url.query), *match.groups())
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def respond(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_out += len(body)
+
+    def respond_json(self, obj, content_type='application/json'):
+        self.respond(200, json.dumps(obj).encode('utf-8'), content_type=content_type)
+
+    def handle_project(self, body, query, project_id):
+        self.respond_json({'_id': project_id, 'group': 'benchmark', 'label': project_id})
+
+    def handle_subjects(self, body, query, project_id):
+        self.respond_json([])
+
+    def handle_token(self, body, query, token_id):
+        self.respond_json({'access_token': 'benchmark-token'})
+
+    def handle_acquisitions(self, body, query):
+        self.respond_json([])
+
+    def handle_master_code(self, body, query):
+        patient_id = json.loads(body.decode('utf-8')).get('patient_id') or ''
+        self.respond_json({'code': 'MC' + patient_id.strip().upper()})
+
+    def handle_upload(self, body, query, kind):
+        self.respond_json([])
+
+    def handle_qido(self, body, query):
+        data = self.server.data
+        matches = []
+        for series_uid, (study_uid, _) in data.series.items():
+            if query.get('StudyInstanceUID') == [study_uid] or query.get('SeriesInstanceUID') == [series_uid]:
+                matches.append({'0020000D': {'vr': 'UI', 'Value': [study_uid]},
+                                '0020000E': {'vr': 'UI', 'Value': [series_uid]}})
+        self.respond_json(matches, content_type='application/dicom+json')
+
+    def handle_qido_instances(self, body, query, study_uid, series_uid):
+        data = self.server.data
+        patient_id = data.series[series_uid][1]
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['0'])[0]) or None
+        count = len(data.instances.get(series_uid, []))
+        matches = [{'00100020': {'vr': 'LO', 'Value': [patient_id]}, '00080060': {'vr': 'CS', 'Value': ['MR']},
+                    '00280010': {'vr': 'US', 'Value': [data.rows]}, '00280011': {'vr': 'US', 'Value': [data.rows]},
+                    '00280100': {'vr': 'US', 'Value': [16]}, '00280002': {'vr': 'US', 'Value': [1]}}
+                   for _ in range(count)][offset:offset + limit if limit else None]
+        self.respond_json(matches, content_type='application/dicom+json')
+
+    def handle_wado(self, body, query, study_uid, series_uid):
+        parts = []
+        for instance in self.server.data.instances.get(series_uid, []):
+            parts.append('--{}\r\nContent-Type: application/dicom\r\n\r\n'.format(BOUNDARY).encode('ascii'))
+            parts.append(instance)
+            parts.append(b'\r\n')
+        parts.append('--{}--\r\n'.format(BOUNDARY).encode('ascii'))
+        content_type = 'multipart/related; type="application/dicom"; boundary={}'.format(BOUNDARY)
+        self.respond(200, b''.join(parts), content_type=content_type)
+
+    def handle_hl7(self, body, query, msg_id):
+        msg = self.server.data.hl7s.get(msg_id)
+        if msg is None:
+            return self.respond(404, b'{}')
+        self.respond_json(msg)
+
+    def handle_fhir_read(self, body, query, ref):
+        resource = self.server.data.get_fhir(ref)
+        if resource is None:
+            return self.respond(404, b'{}')
+        self.respond_json(resource)
+
+    def handle_fhir_batch(self, body, query):
+        entries = []
+        for entry in json.loads(body.decode('utf-8'))['entry']:
+            resource = self.server.data.get_fhir(entry['request']['url'])
+            if resource is None:
+                entries.append({'response': {'status': '404 Not Found'}})
+            else:
+                entries.append({'resource': resource, 'response': {'status': '200 OK'}})
+        self.respond_json({'resourceType': 'Bundle', 'type': 'batch-response', 'entry': entries})
+
+
+class LocalHealthcareClient:
+    # the subset of the Healthcare API client used by run.py, talking to the stand-in server
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+        self.dicomStores = types.SimpleNamespace(dicomWeb=lambda name: DICOMwebClient(url=url + '/dicomWeb'))
+        self.hl7V2Stores = types.SimpleNamespace(messages=types.SimpleNamespace(get=self.get_hl7_message))
+        self.fhirStores = types.SimpleNamespace(fhir=types.SimpleNamespace(read=self.read_fhir,
+                                                                           executeBundle=self.execute_bundle))
+
+    def request(self, method, path, **kwargs):
+        resp = self.session.request(method, self.url + path, **kwargs)
+        resp.raise_for_status()
+        return resp.json()
+
+    def get_hl7_message(self, name):
+        return self.request('GET', '/hl7/messages/' + name.split('/messages/')[1])
+
+    def read_fhir(self, name):
+        return self.request('GET', '/fhir/' + name.split('/fhir/')[1])
+
+    def execute_bundle(self, parent, body):
+        return self.request('POST', '/fhir', json=body)
+
+
+class BenchContext:
+    def __init__(self, config, api_key, input_path, output_dir):
+        self.config = config
+        self.api_key = api_key
+        self.input_path = input_path
+        self.output_dir = output_dir
+
+    def get_input(self, name):
+        if name == 'key':
+            return {'key': self.api_key}
+        if name == 'object_references':
+            return {'location': {'path': self.input_path}}
+        return None
+
+    def get_input_path(self, name):
+        return self.input_path if name == 'object_references' else None
+
+    def open_input(self, name, mode='r'):
+        return open(self.input_path, mode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--patients', type=int, default=10)
+    parser.add_argument('--series', type=int, default=20)
+    parser.add_argument('--instances', type=int, default=50)
+    parser.add_argument('--rows', type=int, default=128)
+    parser.add_argument('--hl7s', type=int, default=200)
+    parser.add_argument('--fhirs', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--config', type=json.loads, default={}, help='gear config overrides as JSON')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(message)s')
+
+    data = SyntheticData(args.patients, args.series, args.instances, args.rows, args.hl7s, args.fhirs)
+    server = StandInServer(data, latency=args.latency, error_rate=args.error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    config = {
+        'log_level': 'WARNING',
+        'project_id': 'benchmark',
+        'auth_token_id': 'token',
+        'hc_dicomstore': 'datasets/bench/dicomStores/bench',
+        'hc_hl7store': 'datasets/bench/hl7V2Stores/bench',
+        'hc_fhirstore': 'datasets/bench/fhirStores/bench',
+    }
+    config.update(args.config)
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_path = os.path.join(tempdir, 'object_references.json')
+        with open(input_path, 'w') as f:
+            json.dump(data.object_references, f)
+        context = BenchContext(config, server.url + '/api:benchmark-key', input_path, tempdir)
+
+        start = time.perf_counter()
+        with mock.patch('run.HealthcareAPIClient', lambda token: LocalHealthcareClient(server.url)):
+            run.main(context)
+        elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    dicom_bytes = sum(len(instance) for instances in data.instances.values() for instance in instances)
+    print('dataset:         {} series x {} instances ({:.1f} MB), {} HL7 messages, {} FHIR resources'.format(
+        args.series, args.instances, dicom_bytes / 1e6, args.hl7s, len(data.object_references['fhirs'])))
+    print('wall time:       {:.2f}s'.format(elapsed))
+    print('peak RSS:        {:.0f} MB (largest child {:.0f} MB)'.format(rss_self, rss_children))
+    print('bytes moved:     {:.1f} MB down, {:.1f} MB up'.format(server.bytes_out / 1e6, server.bytes_in / 1e6))
+    print('requests:        {} ({} injected errors)'.format(sum(server.requests.values()), server.errors))
+    for name, count in sorted(server.requests.items()):
+        print('  {:<15}{}'.format(name, count))
+    run.log.setLevel(logging.INFO)
+    run.METRICS.log_summary()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Compare the indexed LOINC lookup with the legacy per-call CSV scan.
+
+Usage: python -m benchmarks.loinc_lookup [--table LoincTableCore.csv] [--lookups 200]
+"""
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+
+import run
+
+
+def scan_lookup(table_path, loinc_number):
+    with open(table_path, newline='') as csvfile:
+        dialect = csv.Sniffer().sniff(csvfile.read(1024))
+        csvfile.seek(0)
+        reader = csv.DictReader(csvfile, dialect=dialect)
+        for row in reader:
+            if row['LOINC_NUM'] == loinc_number:
+                return row
+        return None
+
+
+def write_synthetic_table(path, rows):
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_ALL)
+        writer.writerow(['LOINC_NUM', 'COMPONENT', 'PROPERTY', 'SYSTEM', 'SHORTNAME', 'LONG_COMMON_NAME'])
+        for i in range(rows):
+            writer.writerow(['{}-{}'.format(10000 + i, i % 10), 'Component {}'.format(i), 'SCnc', 'Bld',
+                             'Short name {}'.format(i), 'Long common name {}'.format(i)])
+
+
+def timed(func, codes):
+    start = time.perf_counter()
+    for code in codes:
+        func(code)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--table', default=run.LOINC_TABLE_PATH)
+    parser.add_argument('--rows', type=int, default=90000, help='synthetic table size if --table is missing')
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        table_path = args.table
+        if not os.path.exists(table_path):
+            table_path = os.path.join(tempdir, 'LoincTableCore.csv')
+            write_synthetic_table(table_path, args.rows)
+        index_path = os.path.join(tempdir, 'LoincTableCore.sqlite')
+
+        start = time.perf_counter()
+        run.LoincIndex.build(table_path, index_path)
+        build_time = time.perf_counter() - start
+
+        with open(table_path, newline='') as csvfile:
+            all_codes = [row['LOINC_NUM'] for row in csv.DictReader(csvfile)]
+        codes = [random.choice(all_codes) for _ in range(args.lookups)]
+
+        scan_time = timed(lambda code: scan_lookup(table_path, code), codes)
+        index = run.LoincIndex(index_path)
+        cold_time = timed(index.lookup, codes)
+        warm_time = timed(index.lookup, codes)
+
+    print('table rows:      {}'.format(len(all_codes)))
+    print('index build:     {:.3f}s'.format(build_time))
+    for label, elapsed in (('csv scan', scan_time), ('index (cold)', cold_time), ('index (warm)', warm_time)):
+        print('{:<16} {:.1f}us/lookup'.format(label + ':', elapsed / len(codes) * 1e6))
+    print('speedup (cold):  {:.0f}x'.format(scan_time / cold_time))
+
+
+if __name__ == '__main__':
+    main()
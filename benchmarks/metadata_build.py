@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Compare the per-message CPU cost of building HL7 upload metadata with the legacy implementation.
+
+Usage: python -m benchmarks.metadata_build [--messages 200] [--segments 500] [--data-kb 512]
+"""
+import argparse
+import base64
+import copy
+import logging
+import os
+import pprint
+import time
+
+import run
+
+
+PROJECT = {'group': 'benchmark', 'label': 'benchmark'}
+
+
+def synthetic_message(segments, data_kb):
+    obx = [{'segmentId': 'OBX',
+            'fields': {'0': 'OBX', '1': str(i), '3.1': '{}-{}'.format(10000 + i, i % 10), '3.2': 'Component {}'.format(i),
+                       '5': str(i * 1.5), '6.1': 'mg/dL', '14': '20190101120000'}}
+           for i in range(segments)]
+    return {
+        'name': 'projects/p/locations/l/datasets/d/hl7V2Stores/s/messages/bench',
+        'messageType': 'ORU',
+        'sendTime': '2019-01-01T12:00:00Z',
+        'sendFacility': 'BENCH',
+        'data': base64.b64encode(os.urandom(data_kb * 1024)).decode('ascii'),
+        'labels': {'source.system': 'bench'},
+        'parsedData': {'segments': [
+            {'segmentId': 'MSH', 'fields': {'0': 'MSH', '9': 'bench'}},
+            {'segmentId': 'PID', 'fields': {'0': 'PID', '3.1': 'MRN-BENCH', '5.1': 'First', '5.2': 'Last',
+                                            '7': '19700101', '8': 'F'}},
+        ] + obx},
+    }
+
+
+def legacy_get_metadata(dcm):
+    metadata = {}
+    for group in ('subject', 'session', 'acquisition'):
+        prefix = group + '_'
+        group_attrs = [attr for attr in dir(dcm) if attr.startswith(prefix) and getattr(dcm, attr)]
+        metadata[group] = {k.replace(prefix, ''): getattr(dcm, k) for k in group_attrs}
+    metadata['session']['subject'] = metadata.pop('subject')
+    return metadata
+
+
+def legacy_normalize_dict_keys(d):
+    new = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            v = legacy_normalize_dict_keys(v)
+        elif isinstance(v, list):
+            v = [legacy_normalize_dict_keys(i) for i in v]
+        new[k.replace('.', '_')] = v
+    return new
+
+
+def legacy_build(msg, msg_obj):
+    file_meta = legacy_normalize_dict_keys(copy.deepcopy(msg))
+    del file_meta['data']
+    metadata = legacy_get_metadata(msg_obj)
+    metadata.setdefault('group', {})['_id'] = PROJECT['group']
+    metadata.setdefault('project', {})['label'] = PROJECT['label']
+    subject_info = copy.deepcopy(metadata['session']['subject'])
+    metadata['session']['subject'] = {'master_code': 'BENCH'}
+    metadata['acquisition']['files'] = [{'name': msg_obj.msg_control_id + '.hl7.txt', 'type': 'hl7',
+                                         'info': file_meta}]
+    for key in run.HL7_SUBJECT_FIELDS:
+        if subject_info.get(key):
+            metadata['session']['subject'][key] = subject_info[key]
+    run.log.debug('     Upload metadata:\n%s', pprint.pformat(metadata))
+    return metadata
+
+
+def current_build(msg, msg_obj):
+    file_meta = run.normalize_dict_keys(msg, exclude=('data',))
+    metadata = run.get_metadata(msg_obj)
+    run.set_upload_containers(metadata, PROJECT, 'BENCH', None, run.HL7_SUBJECT_FIELDS)
+    metadata['acquisition']['files'] = [{'name': msg_obj.msg_control_id + '.hl7.txt', 'type': 'hl7',
+                                         'info': file_meta}]
+    run.log.debug('     Upload metadata:\n%s', run.LazyPformat(metadata))
+    return metadata
+
+
+def timed(build, messages):
+    start = time.process_time()
+    for msg, msg_obj in messages:
+        build(msg, msg_obj)
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--segments', type=int, default=500)
+    parser.add_argument('--data-kb', type=int, default=512)
+    args = parser.parse_args()
+
+    run.log.setLevel(logging.INFO)
+    msg = synthetic_message(args.segments, args.data_kb)
+    messages = [(msg, run.HL7Message(msg))] * args.messages
+    assert legacy_build(*messages[0]) == current_build(*messages[0])
+
+    legacy_time = timed(legacy_build, messages)
+    current_time = timed(current_build, messages)
+    print('messages:        {} ({} segments, {} KB data)'.format(args.messages, args.segments, args.data_kb))
+    for label, elapsed in (('legacy', legacy_time), ('current', current_time)):
+        print('{:<16} {:.2f}ms/message'.format(label + ':', elapsed / args.messages * 1e3))
+    print('speedup:         {:.1f}x'.format(legacy_time / current_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,43 @@
 #!/usr/bin/env python3
 
 import base64
+import collections
+import concurrent.futures
+import contextlib
 import copy
 import csv
 import datetime
+import email.utils
 import flywheel
+import functools
+import hashlib
+import heapq
+import io
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 import pprint
+import queue
+import random
 import shutil
+import sqlite3
+import sys
 import tempfile
+import threading
+import time
+import types
+import uuid
 import zipfile
+import zlib
 from urllib.parse import urljoin
 
 import dateutil.parser
+import pydicom
 import pytz
 import requests
-from dicomweb_client.api import load_json_dataset
+import requests.adapters
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
 from flywheel_migration.dcm import DicomFile
@@ -40,11 +60,100 @@ HL7_ETHNIC_GROUP_MAP = {
     'U': 'Unknown or Not Reported',
 }
 
+LOINC_TABLE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'LoincTableCore.csv')
+LOINC_INDEX_PATH = os.path.splitext(LOINC_TABLE_PATH)[0] + '.sqlite'
+LOINC_CACHE_SIZE = 4096
+
+MASTER_CODE_WORKERS = 4
+PREFETCH_CHUNK_SIZE = 100
+HL7_FETCH_WORKERS = 8
+FHIR_BATCH_SIZE = 100
+FHIR_FETCH_WORKERS = 4
+FHIR_PAYLOAD_MODES = ('full', 'compact')
+FHIR_INFO_FIELDS = 'resourceType,id,identifier,status,category,code,subject,encounter'
+UPLOAD_BATCH_SIZE = 100
+UPLOAD_BATCH_MB = 32
+UPLOAD_BATCH_SECONDS = 30
+METADATA_GROUPS = ('subject', 'session', 'acquisition')
+# subject fields of the metadata set on subjects that don't have them yet
+DICOM_SUBJECT_FIELDS = ('code', 'firstname', 'lastname')
+HL7_SUBJECT_FIELDS = ('code', 'firstname', 'lastname', 'sex', 'ethnicity', 'type')
+FHIR_SUBJECT_FIELDS = ('code', 'firstname', 'lastname', 'sex', 'type')
+JOURNAL_FILENAME = 'import_journal.jsonl'
+SERIES_ACQUISITIONS_INFO_KEY = 'ghc_import_series_acquisitions'
+SHARD_REPORT_FILENAME = 'shard_{}_report.json'
+PLAN_FILENAME = 'import_plan.jsonl'
+PLAN_SUMMARY_FILENAME = 'import_plan_summary.json'
+PLAN_PAGE_SIZE = 1000
+SYNC_INFO_KEY = 'ghc_import_sync'
+SYNC_PAGE_SIZE = 1000
+# watermarks are set this much before the job started, to allow for clock skew and late writes
+SYNC_OVERLAP = datetime.timedelta(minutes=5)
+SYNC_FHIR_TYPES = 'Patient,Encounter,Observation,DiagnosticReport,Condition,Procedure'
+SYNC_STORES = collections.OrderedDict([('dicoms', 'hc_dicomstore'), ('hl7s', 'hc_hl7store'), ('fhirs', 'hc_fhirstore')])
+# instance attributes read from QIDO to estimate the size of a series without retrieving it
+PLAN_INSTANCE_TAGS = collections.OrderedDict([
+    ('PatientID', '00100020'),
+    ('Modality', '00080060'),
+    ('SeriesDescription', '0008103E'),
+    ('Rows', '00280010'),
+    ('Columns', '00280011'),
+    ('BitsAllocated', '00280100'),
+    ('SamplesPerPixel', '00280002'),
+    ('NumberOfFrames', '00280008'),
+])
+DICOM_HEADER_SIZE_ESTIMATE = 4096
+METRICS_JSON_FILENAME = 'metrics.json'
+METRICS_PROM_FILENAME = 'metrics.prom'
+# latency histogram bucket upper bounds in seconds
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+RETRY_ATTEMPTS = 5
+RETRY_BACKOFF = 0.5
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+RETRY_AFTER_MAX = 60
+HTTP_POOL_SIZE = 32
+HTTP_MAX_CONCURRENCY = 32
+
+DICOM_DOWNLOAD_WORKERS = 2
+DICOM_PACK_WORKERS = 1
+DICOM_UPLOAD_WORKERS = 2
+DICOM_MAX_SERIES_IN_FLIGHT = 4
+# temp storage reserved for the first series of a run, later ones reserve the mean size so far
+DICOM_SERIES_ESTIMATE_MB = 64
+DICOM_SEARCH_WORKERS = 8
+# QIDO attributes read from the raw DICOM JSON search results, the UIDs are also the search keys
+SERIES_SEARCH_TAGS = collections.OrderedDict([
+    ('StudyInstanceUID', '0020000D'),
+    ('SeriesInstanceUID', '0020000E'),
+    ('PatientID', '00100020'),
+])
+UID_SEARCH_FIELDS = ['StudyInstanceUID', 'SeriesInstanceUID']
+
+# request the instances in their stored transfer syntax, there's no need to have them transcoded
+DICOM_STREAM_ACCEPT = 'multipart/related; type="application/dicom"; transfer-syntax=*'
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+DICOM_DEFLATE_LEVEL = 6
+DICOM_COMPRESS_WINDOW_MB = 64
+# members are compressed ahead of the archive writer through ZipFile internals (see
+# write_compressed_member) on the python versions they were checked against, others stream them
+ZIPFILE_PRECOMPRESS = (3, 6) <= sys.version_info[:2] <= (3, 13)
+PARSE_CHUNK_SIZE = 16
+COMPRESSED_TRANSFER_SYNTAXES = {
+    '1.2.840.10008.1.2.1.99',  # Deflated Explicit VR Little Endian
+    '1.2.840.10008.1.2.5',  # RLE Lossless
+}
+
 
 def main(context):
     config = context.config
 
     log.setLevel(getattr(logging, config['log_level']))
+    TRANSPORT.configure(pool_size=config.get('http_pool_size', HTTP_POOL_SIZE),
+                        max_concurrency=config.get('http_max_concurrency', HTTP_MAX_CONCURRENCY),
+                        retries=config.get('http_retries', RETRY_ATTEMPTS))
 
     api_key = context.get_input('key')['key']
 
@@ -68,269 +177,1498 @@ def main(context):
     resp.raise_for_status()
     access_token = resp.json()['access_token']
     hc_api = HealthcareAPIClient(access_token)
+    subjects = SubjectIndex(fw_api, proj)
+    master_codes = MasterCodeResolver(fw_api, workers=config.get('master_code_workers', MASTER_CODE_WORKERS))
+    shard = Shard(config.get('shard_index', 0), config.get('shard_count', 1))
+    sync = SyncState(fw_api, proj, shard) if config.get('sync', False) else None
+    if sync is None and context.get_input('object_references') is None:
+        raise Exception('The object_references input is required unless sync is enabled')
+    # units completed by this and resumed runs, and optionally what the project already contains. Syncs
+    # always check the project, the watermarks overlap with the previous run. Dry runs only read the
+    # resumed journal, units they find in the project aren't recorded anywhere.
+    dry_run = config.get('dry_run', False)
+    journal = ImportJournal(None if dry_run else os.path.join(context.output_dir, JOURNAL_FILENAME),
+                            resume_path=context.get_input_path('journal'))
+    imported = ImportedIndex(fw_api, proj) if config.get('skip_existing', False) or sync is not None else None
+
+    try:
+        if dry_run:
+            plan_import(context, hc_api, config, journal, imported, shard, sync=sync)
+            shard.completed = True
+            return
+
+        dicom_refs = get_object_references(context, hc_api, config, sync, 'dicoms')
+        if dicom_refs is not None:
+            import_dicom_files(hc_api, config['hc_dicomstore'], dicom_refs, fw_api, proj,
+                               config.get('de_identify', False), subjects=subjects, master_codes=master_codes,
+                               config=config, journal=journal, imported=imported, shard=shard)
+        if sync is not None:
+            sync.advance('dicoms', config.get('hc_dicomstore'), failed=journal.get_failed('dicom'))
+
+        hl7_refs = get_object_references(context, hc_api, config, sync, 'hl7s')
+        if hl7_refs is not None:
+            import_hl7_messages(hc_api, config['hc_hl7store'], hl7_refs, fw_api, proj,
+                                subjects=subjects, master_codes=master_codes, config=config, journal=journal,
+                                imported=imported, shard=shard)
+        if sync is not None:
+            sync.advance('hl7s', config.get('hc_hl7store'), failed=journal.get_failed('hl7'))
+
+        fhir_refs = get_object_references(context, hc_api, config, sync, 'fhirs')
+        if fhir_refs is not None:
+            import_fhir_resources(hc_api, config['hc_fhirstore'], fhir_refs, fw_api, proj,
+                                  subjects=subjects, master_codes=master_codes, config=config, journal=journal,
+                                  imported=imported, shard=shard)
+        if sync is not None:
+            sync.advance('fhirs', config.get('hc_fhirstore'), failed=journal.get_failed('fhir'))
+        shard.completed = True
+    finally:
+        journal.close()
+        shard.write(context.output_dir)
+        METRICS.log_summary()
+        METRICS.write(context.output_dir)
+
+
+def get_object_references(context, hc_api, config, sync, key):
+    if sync is None:
+        return read_object_references(context, key)
+    store = config.get(SYNC_STORES[key])
+    if not store:
+        return None
+    since = sync.get_watermark(key, store)
+    log.info('Listing %s changed since %s', key, since or 'the first sync')
+    if key == 'dicoms':
+        refs = search_dicom_changes(hc_api, store, since)
+    elif key == 'hl7s':
+        refs = list_hl7_changes(hc_api, store, since)
+    else:
+        resource_types = [t.strip() for t in config.get('sync_fhir_types', SYNC_FHIR_TYPES).split(',') if t.strip()]
+        refs = search_fhir_changes(hc_api, store, resource_types, since)
+    return peek_references(refs)
+
+
+def read_object_references(context, key):
+    # lazily reads the references of one kind from the input, None if there are none. Each kind
+    # re-reads the file instead of holding every reference in memory.
+    return peek_references(iter_object_references(context, key))
+
+
+def peek_references(refs):
+    first = next(refs, None)
+    if first is None:
+        return None
+    return itertools.chain([first], refs)
 
-    with context.open_input('object_references', 'r') as input_file:
-        object_references = json.load(input_file)
-
-    if object_references.get('dicoms'):
-        import_dicom_files(hc_api, config['hc_dicomstore'], object_references['dicoms'], fw_api, proj, config.get('de_identify', False))
-
-    if object_references.get('hl7s'):
-        import_hl7_messages(hc_api, config['hc_hl7store'], object_references['hl7s'], fw_api, proj)
-
-    if object_references.get('fhirs'):
-        import_fhir_resources(hc_api, config['hc_fhirstore'], object_references['fhirs'], fw_api, proj)
 
-def import_dicom_files(hc_api, hc_dicomstore, dcm_ids, fw_api, fw_project, de_identify=False):
+def iter_object_references(context, key):
+    with context.open_input('object_references', 'r') as input_file:
+        for ref_key, ref in ReferenceReader(input_file).iter_references():
+            if ref_key == key:
+                yield ref
+
+
+class ReferenceReader:
+    # incremental parser of object_references: a JSON object, or newline delimited objects, mapping
+    # dicoms/hl7s/fhirs to a list of references or a single reference
+    def __init__(self, fileobj, chunk_size=STREAM_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.fileobj.read(self.chunk_size)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.fill()
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Invalid object_references, expected one of {!r} but found {!r}'.format(chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a value ending with the buffer might continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def iter_references(self):
+        while self.peek():
+            self.expect('{')
+            if self.peek() == '}':
+                self.pos += 1
+                continue
+            while True:
+                key = self.value()
+                self.expect(':')
+                if self.peek() == '[':
+                    self.pos += 1
+                    if self.peek() == ']':
+                        self.pos += 1
+                    else:
+                        while True:
+                            ref = self.value()
+                            if ref:
+                                yield key, ref
+                            if self.expect(',]') == ']':
+                                break
+                else:
+                    ref = self.value()
+                    if ref:
+                        yield key, ref
+                if self.expect(',}') == '}':
+                    break
+
+
+def import_dicom_files(hc_api, hc_dicomstore, dcm_ids, fw_api, fw_project, de_identify=False, subjects=None,
+                       master_codes=None, config=None, journal=None, imported=None, shard=None):
     log.info('Importing DICOM files...')
-    dicomweb =hc_api.dicomStores.dicomWeb(name=hc_dicomstore)
-
-    for study_uid, series_uid in search_uids(dicomweb, dcm_ids):
-        log.info('  Processing series %s', series_uid)
-        with tempfile.TemporaryDirectory() as tempdir:
-            series_dir = os.path.join(tempdir, series_uid)
-            os.mkdir(series_dir)
-            log.debug('     Downloading...')
-            for dicom in dicomweb.retrieve_series(study_uid, series_uid):
-                dicom.save_as(os.path.join(series_dir, dicom.SOPInstanceUID))
-
-            log.debug('     Packing...')
-            metadata_map = pkg_series(series_dir, de_identify=de_identify, timezone=DEFAULT_TZ, map_key='PatientID')
-
-            log.debug('     Uploading...')
-            for filepath, metadata in sorted(metadata_map.items()):
-                subj_code_payload = {
-                    'patient_id': metadata['patient_id'],
-                    'use_patient_id': True
-                }
-                del metadata['patient_id']
-                master_subject_code = get_master_subject_code(subj_code_payload, fw_api)
-                subject = get_subject_by_master_code(master_subject_code, fw_project, fw_api)
-
-                metadata.setdefault('group', {})['_id'] = fw_project['group']
-                metadata.setdefault('project', {})['label'] = fw_project['label']
-                subject_info = copy.deepcopy(metadata['session']['subject'])
-                metadata['session']['subject'] = {'master_code': master_subject_code}
-
-                for key in ('code', 'firstname', 'lastname'):
-                    if not (subject and subject.get(key)) and subject_info.get(key):
-                        metadata['session']['subject'][key] = subject_info[key]
-
-                metadata_json = json.dumps(metadata, default=metadata_encoder)
-
-                filename = os.path.basename(filepath)
-                with open(filepath, 'rb') as f:
-                    mpe = MultipartEncoder(fields={'metadata': metadata_json, 'file': (filename, f)})
-                    resp = fw_api.post('upload/uid', data=mpe, headers={'Content-Type': mpe.content_type})
-                    resp.raise_for_status()
-
-
-def import_hl7_messages(hc_api, hc_hl7store, hl7_ids, fw_api, fw_project):
-    log.info('Importing HL7 messages...')
-    for msg_id in hl7_ids:
-        log.info('  Processing HL7 message %s', msg_id)
-        msg = hc_api.hl7V2Stores.messages.get(name='{}/messages/{}'.format(hc_hl7store, msg_id))
+    config = config or {}
+    journal = journal or ImportJournal()
+    shard = shard or Shard()
+    subjects = subjects or SubjectIndex(fw_api, fw_project)
+    master_codes = master_codes or MasterCodeResolver(fw_api)
+    dicomweb = get_dicomweb(hc_api, hc_dicomstore)
+    stream_upload = config.get('dicom_upload_mode', 'stream') == 'stream'
+    uploader = ArchiveUploader(fw_api, stream=stream_upload)
+    compress_workers = config.get('dicom_compress_workers') or os.cpu_count() or 1
+    compress_executor = concurrent.futures.ThreadPoolExecutor(max_workers=compress_workers)
+    compressor = MemberCompressor(mode=config.get('dicom_compression', 'auto'),
+                                  level=config.get('dicom_deflate_level', DICOM_DEFLATE_LEVEL),
+                                  executor=compress_executor,
+                                  window_bytes=config.get('dicom_compress_window_mb',
+                                                          DICOM_COMPRESS_WINDOW_MB) * 1024 * 1024)
+    parse_processes = config.get('dicom_parse_processes') or os.cpu_count() or 1
+    parse_executor = (concurrent.futures.ProcessPoolExecutor(max_workers=parse_processes, mp_context=get_process_context())
+                      if parse_processes > 1 else None)
+    storage = TempStorage(root=config.get('dicom_temp_dir') or None,
+                          budget=config.get('dicom_temp_budget_mb', 0) * 1024 * 1024)
+    storage.check_free_space(storage.budget)
+
+    pipeline = Pipeline([
+        ('download', functools.partial(download_series, dicomweb, stream=config.get('dicom_stream_retrieve', True),
+                                       storage=storage),
+         config.get('dicom_download_workers', DICOM_DOWNLOAD_WORKERS)),
+        ('pack', functools.partial(pack_series, de_identify=de_identify, stream=stream_upload, compressor=compressor,
+                                   parse_executor=parse_executor),
+         config.get('dicom_pack_workers', DICOM_PACK_WORKERS)),
+        ('upload', functools.partial(upload_series, uploader=uploader, fw_project=fw_project, subjects=subjects,
+                                     master_codes=master_codes, journal=journal),
+         config.get('dicom_upload_workers', DICOM_UPLOAD_WORKERS)),
+    ], max_in_flight=config.get('dicom_max_series_in_flight', DICOM_MAX_SERIES_IN_FLIGHT), finalize=DicomSeries.cleanup)
+    try:
+        series_uids = search_uids(dicomweb, dcm_ids, workers=config.get('dicom_search_workers', DICOM_SEARCH_WORKERS))
+        pipeline.run(DicomSeries(study_uid, series_uid) for study_uid, series_uid, patient_id in series_uids
+                     if shard.owns('dicom', series_uid, patient_id) and
+                     not is_imported(journal, imported, 'dicom', series_uid, series_uid=series_uid))
+    finally:
+        compress_executor.shutdown()
+        if parse_executor is not None:
+            parse_executor.shutdown()
+    master_codes.log_stats()
+
+
+class TempStorage:
+    # byte budget for the temp files of the series in flight. Series reserve an estimate of their size
+    # before the download starts and wait there while the budget is used up, except the oldest series
+    # which always proceeds so that the pipeline can't deadlock on partially downloaded series. Bytes are
+    # allocated against the reservation before they are written, a series outgrowing its estimate extends
+    # the reservation without waiting as its WADO response is being read by then.
+    def __init__(self, root=None, budget=0):
+        self.root = root
+        self.budget = budget
+        self.used = 0
+        self.usage = collections.OrderedDict()
+        self.allocated = {}
+        self.series_count = 0
+        self.series_bytes = 0
+        self.cond = threading.Condition()
+
+    def check_free_space(self, nbytes):
+        free = shutil.disk_usage(self.root or tempfile.gettempdir()).free
+        if free < nbytes:
+            raise Exception('Not enough free space in {} for DICOM temp files: {:.1f} MB needed, {:.1f} MB free'.format(
+                self.root or tempfile.gettempdir(), nbytes / 1e6, free / 1e6))
+
+    def open(self, owner):
+        with self.cond:
+            self.usage[owner] = 0
+            self.allocated[owner] = 0
+
+    def estimate(self):
+        # mean size of the series downloaded so far
+        with self.cond:
+            if self.series_count:
+                nbytes = self.series_bytes // self.series_count
+            else:
+                nbytes = DICOM_SERIES_ESTIMATE_MB * 1024 * 1024
+        return min(nbytes, self.budget) if self.budget else nbytes
+
+    def reserve(self, owner, nbytes, wait=True):
+        with self.cond:
+            while (wait and self.budget and self.used + nbytes > self.budget and
+                   owner is not next(iter(self.usage))):
+                self.cond.wait()
+            if self.budget and self.used <= self.budget < self.used + nbytes:
+                log.warning('  Series exceeds the temp storage budget, %.1f MB in use', (self.used + nbytes) / 1e6)
+            self.usage[owner] += nbytes
+            self.used += nbytes
+        # room for at least this much more, rather than failing halfway through an archive
+        self.check_free_space(nbytes)
+
+    def allocate(self, owner, nbytes):
+        # called before writing nbytes of the owner's temp files
+        with self.cond:
+            self.allocated[owner] += nbytes
+            shortfall = self.allocated[owner] - self.usage[owner]
+        if shortfall > 0:
+            self.reserve(owner, shortfall, wait=False)
+
+    def resize(self, owner, nbytes):
+        # the owner's temp files take nbytes now, the reservation follows
+        with self.cond:
+            self.allocated[owner] = nbytes
+            extra = nbytes - self.usage[owner]
+        if extra > 0:
+            self.reserve(owner, extra, wait=False)
+        else:
+            self.release(owner, -extra)
+
+    def finish_download(self, owner):
+        # returns the unused part of the estimate, the series size feeds the next estimates
+        with self.cond:
+            self.series_count += 1
+            self.series_bytes += self.allocated[owner]
+            nbytes = self.allocated[owner]
+        self.resize(owner, nbytes)
+
+    def release(self, owner, nbytes):
+        with self.cond:
+            nbytes = min(nbytes, self.usage.get(owner, 0))
+            self.usage[owner] -= nbytes
+            self.used -= nbytes
+            self.cond.notify_all()
+
+    def close(self, owner):
+        with self.cond:
+            self.used -= self.usage.pop(owner, 0)
+            self.allocated.pop(owner, None)
+            self.cond.notify_all()
+
+
+class DicomSeries:
+    def __init__(self, study_uid, series_uid):
+        self.study_uid = study_uid
+        self.series_uid = series_uid
+        self.storage = None
+        self.tempdir = None
+        self.series_dir = None
+        self.archives = []
+
+    def cleanup(self):
+        if self.tempdir is not None:
+            self.tempdir.cleanup()
+            self.tempdir = None
+        if self.storage is not None:
+            self.storage.close(self)
+            self.storage = None
+
+
+def get_process_context():
+    # the parse pool starts its workers from pipeline threads while other threads hold locks (HTTP
+    # pools, logging), forked workers could inherit them locked; forkserver forks a clean process
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def get_dicomweb(hc_api, hc_dicomstore):
+    dicomweb = hc_api.dicomStores.dicomWeb(name=hc_dicomstore)
+    # dicomweb-client has no public accessor for its requests session, see requirements.txt
+    TRANSPORT.mount(dicomweb._session)
+    return dicomweb
+
+
+def get_series_wado_url(dicomweb, study_uid, series_uid):
+    # built the way dicomweb-client does it, from its public base URL and WADO prefix
+    service_url = dicomweb.base_url
+    if getattr(dicomweb, 'wado_url_prefix', None):
+        service_url += '/' + dicomweb.wado_url_prefix
+    return '{}/studies/{}/series/{}'.format(service_url, study_uid, series_uid)
+
+
+def download_series(dicomweb, series, stream=True, storage=None):
+    log.info('  Downloading series %s', series.series_uid)
+    series.storage = storage or TempStorage()
+    series.storage.open(series)
+    # waits here while other series hold the temp storage budget, before the WADO request is sent
+    series.storage.reserve(series, series.storage.estimate())
+    series.tempdir = tempfile.TemporaryDirectory(dir=series.storage.root)
+    series.series_dir = os.path.join(series.tempdir.name, series.series_uid)
+    os.mkdir(series.series_dir)
+    allocate = functools.partial(series.storage.allocate, series)
+    with METRICS.timer('download', 'dicom') as sample:
+        if stream:
+            filepaths = stream_series(dicomweb, series.study_uid, series.series_uid, series.series_dir, allocate)
+        else:
+            filepaths = save_series(dicomweb, series.study_uid, series.series_uid, series.series_dir, allocate)
+        for _ in filepaths:
+            pass
+        sample.bytes = get_dir_size(series.series_dir)
+    series.storage.finish_download(series)
+
+
+def get_dir_size(path):
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, _, filenames in os.walk(path) for filename in filenames)
+
+
+def save_series(dicomweb, study_uid, series_uid, outdir, allocate=None):
+    for dicom in dicomweb.retrieve_series(study_uid, series_uid):
+        filepath = os.path.join(outdir, dicom.SOPInstanceUID)
+        buf = io.BytesIO()
+        dicom.save_as(buf)
+        if allocate is not None:
+            allocate(buf.tell())
+        with open(filepath, 'wb') as f:
+            f.write(buf.getbuffer())
+        yield filepath
+
+
+def stream_series(dicomweb, study_uid, series_uid, outdir, allocate=None):
+    # write the instances of the WADO-RS multipart response to disk as they arrive, without decoding them
+    url = get_series_wado_url(dicomweb, study_uid, series_uid)
+    with dicomweb._session.get(url, headers={'Accept': DICOM_STREAM_ACCEPT}, stream=True) as resp:
+        resp.raise_for_status()
+        content_type = resp.headers.get('Content-Type', '')
+        boundary = get_multipart_boundary(content_type)
+        if boundary is None:
+            raise ValueError('Unexpected WADO-RS response content type: {}'.format(content_type))
+        for part_path in save_multipart_parts(resp.iter_content(STREAM_CHUNK_SIZE), boundary, outdir, allocate):
+            dcm = pydicom.dcmread(part_path, stop_before_pixels=True, specific_tags=['SOPInstanceUID'])
+            filepath = os.path.join(outdir, dcm.SOPInstanceUID)
+            os.rename(part_path, filepath)
+            yield filepath
+
+
+def get_multipart_boundary(content_type):
+    if not content_type.lower().startswith('multipart/'):
+        return None
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'boundary':
+            return value.strip('"')
+    return None
 
-        log.debug('     Creating metadata...')
-        msg_obj = HL7Message(msg)
 
+def save_multipart_parts(chunks, boundary, outdir, allocate=None):
+    # incremental multipart/related parser, yields the path of each part once it is fully written.
+    # allocate is called with the size of each write before it is made
+    delimiter = b'\r\n--' + boundary.encode('ascii')
+    buf = b'\r\n'  # the first delimiter isn't preceded by CRLF
+    state = 'preamble'
+    part_file = part_path = None
+    part_no = 0
+    chunks = iter(chunks)
+    try:
+        while True:
+            if state == 'preamble':
+                idx = buf.find(delimiter)
+                if idx >= 0:
+                    buf = buf[idx + len(delimiter):]
+                    state = 'delimiter'
+                    continue
+                buf = buf[-len(delimiter):]
+            elif state == 'delimiter':
+                if buf.startswith(b'--'):
+                    return
+                idx = buf.find(b'\r\n')
+                if idx >= 0:
+                    buf = buf[idx + 2:]
+                    state = 'headers'
+                    continue
+            elif state == 'headers':
+                idx = 0 if buf.startswith(b'\r\n') else buf.find(b'\r\n\r\n')
+                if idx >= 0:
+                    buf = buf[idx + (2 if idx == 0 else 4):]
+                    part_path = os.path.join(outdir, 'part-{:06d}'.format(part_no))
+                    part_file = open(part_path, 'wb')
+                    part_no += 1
+                    state = 'body'
+                    continue
+            elif state == 'body':
+                idx = buf.find(delimiter)
+                if idx >= 0:
+                    if allocate is not None:
+                        allocate(idx)
+                    part_file.write(buf[:idx])
+                    part_file.close()
+                    part_file = None
+                    buf = buf[idx + len(delimiter):]
+                    state = 'delimiter'
+                    yield part_path
+                    continue
+                # keep a possible partial delimiter at the end of the buffer
+                keep = len(delimiter) - 1
+                if len(buf) > keep:
+                    if allocate is not None:
+                        allocate(len(buf) - keep)
+                    part_file.write(buf[:-keep])
+                    buf = buf[-keep:]
+
+            chunk = next(chunks, None)
+            if chunk is None:
+                if state == 'preamble':
+                    return  # empty response
+                raise ValueError('Truncated multipart response')
+            buf += chunk
+    finally:
+        if part_file is not None:
+            part_file.close()
+
+
+def pack_series(series, de_identify=False, stream=False, compressor=None, parse_executor=None):
+    log.info('  Packing series %s', series.series_uid)
+    with METRICS.timer('pack', 'dicom') as sample:
+        sample.bytes = sum(entry.stat().st_size for entry in os.scandir(series.series_dir))
+        if series.storage is not None and not stream:
+            # archives are written before their instances are removed and take at most about their size
+            series.storage.allocate(series, sample.bytes)
+        series.archives = pkg_series(series.series_dir, stream=stream, compressor=compressor,
+                                     parse_executor=parse_executor, de_identify=de_identify, timezone=DEFAULT_TZ,
+                                     map_key='PatientID')
+    if series.storage is not None:
+        # archived instances were removed and archives written, the rest of the allocation is released
+        series.storage.resize(series, get_dir_size(series.tempdir.name))
+
+
+def upload_series(series, uploader, fw_project, subjects, master_codes, journal):
+    log.info('  Uploading series %s', series.series_uid)
+    master_codes.prefetch(({'patient_id': archive.metadata['patient_id'], 'use_patient_id': True}
+                           for archive in series.archives), 'dicom')
+    # every acquisition lists its siblings so that a partly uploaded series isn't taken as imported
+    acquisition_uids = sorted(archive.arc_name[:-len('.dicom')] for archive in series.archives)
+    allocate = functools.partial(series.storage.allocate, series) if series.storage is not None else None
+    for archive in sorted(series.archives, key=lambda archive: archive.filename):
+        metadata = archive.metadata
+        metadata['acquisition'].setdefault('info', {})[SERIES_ACQUISITIONS_INFO_KEY] = acquisition_uids
         subj_code_payload = {
-            'patient_id': msg_obj.patient_id,
-            'first_name': msg_obj.subject_firstname,
-            'last_name': msg_obj.subject_lastname,
-            'date_of_birth': msg_obj.dob.strftime('%Y-%m-%d'),
-            'use_patient_id': bool(msg_obj.patient_id)
+            'patient_id': metadata['patient_id'],
+            'use_patient_id': True
         }
-
-        master_subject_code = get_master_subject_code(subj_code_payload, fw_api)
-        subject = get_subject_by_master_code(master_subject_code, fw_project, fw_api)
-
-        file_meta = normalize_dict_keys(copy.deepcopy(msg))
-        del file_meta['data']
-
-        metadata = get_metadata(msg_obj)
-        metadata.setdefault('group', {})['_id'] = fw_project['group']
-        metadata.setdefault('project', {})['label'] = fw_project['label']
-        subject_info = copy.deepcopy(metadata['session']['subject'])
-        metadata['session']['subject'] = {'master_code': master_subject_code}
-        metadata['acquisition']['files'] = [
-            {
-                'name': msg_obj.msg_control_id + '.hl7.txt',
-                'type': 'hl7',
-                'info': file_meta
-            }
-        ]
-
-        for key in ('code', 'firstname', 'lastname', 'sex', 'ethnicity', 'type'):
-            if not (subject and subject.get(key)) and subject_info.get(key):
-                metadata['session']['subject'][key] = subject_info[key]
-
-        log.debug('     Upload metadata:\n%s', pprint.pformat(metadata))
-        log.debug('     Uploading...')
+        del metadata['patient_id']
+        master_subject_code = master_codes.get(subj_code_payload, 'dicom')
+        subject = subjects.get(master_subject_code, 'dicom')
+        set_upload_containers(metadata, fw_project, master_subject_code, subject, DICOM_SUBJECT_FIELDS)
 
         metadata_json = json.dumps(metadata, default=metadata_encoder)
-        raw_hl7_msg = base64.b64decode(msg['data'])
-        mpe = MultipartEncoder(fields={'metadata': metadata_json, 'file': (msg_obj.msg_control_id + '.hl7.txt', raw_hl7_msg)})
-        resp = fw_api.post('upload/label', data=mpe, headers={'Content-Type': mpe.content_type})
-        log.debug('     Upload response:\n%s', pprint.pformat(resp.json()))
-        resp.raise_for_status()
-
-
-def import_fhir_resources(hc_api, hc_fhirstore, fhir_refs, fw_api, fw_project):
-    log.info('Importing FHIR resources...')
-    for resource_ref in fhir_refs:
-        resource_type, resource_id = resource_ref.split('/')
-        resource = hc_api.fhirStores.fhir.read(name='{}/fhir/{}/{}'.format(hc_fhirstore, resource_type, resource_id))
-
-        log.debug('     Creating metadata...')
-        resource_obj = FHIRResource(resource, hc_api, hc_fhirstore)
-
-        subj_code_payload = {
-            'patient_id': resource_obj.patient_id,
-            'first_name': resource_obj.subject_firstname,
-            'last_name': resource_obj.subject_lastname,
-            'date_of_birth': resource_obj.dob.strftime('%Y-%m-%d'),
-            'use_patient_id': bool(resource_obj.patient_id)
+        with METRICS.timer('upload', 'dicom') as sample:
+            uploader.upload(archive, metadata_json, allocate=allocate)
+            sample.bytes = archive.size
+        subjects.update(master_subject_code, metadata['session']['subject'])
+        if series.storage is not None:
+            archive.remove_files()
+            series.storage.resize(series, get_dir_size(series.tempdir.name))
+    journal.record('dicom', series.series_uid)
+
+
+class ArchiveUploader:
+    # uploads archives to upload/uid, either generating the zip inside a chunked request body
+    # or from the archive file on disk for servers that require a Content-Length
+    def __init__(self, fw_api, stream=True):
+        self.fw_api = fw_api
+        self.stream = stream
+
+    def upload(self, archive, metadata_json, allocate=None):
+        # request bodies can't be replayed, failed uploads are retried by generating the body again
+        if self.stream:
+            resp = retry_call(self.post_stream, archive, metadata_json)
+            if resp.status_code != 411:
+                return
+            log.warning('  Server requires Content-Length, falling back to uploading archives from disk')
+            self.stream = False
+        if not os.path.exists(archive.path):
+            if allocate is not None:
+                allocate(archive.member_bytes)
+            archive.save()
+        retry_call(self.post_file, archive, metadata_json)
+
+    def post_stream(self, archive, metadata_json):
+        boundary = uuid.uuid4().hex
+        resp = self.fw_api.post('upload/uid', data=iter_multipart_upload(boundary, metadata_json, archive),
+                                headers={'Content-Type': 'multipart/form-data; boundary=' + boundary})
+        if resp.status_code != 411:
+            resp.raise_for_status()
+        return resp
+
+    def post_file(self, archive, metadata_json):
+        with open(archive.path, 'rb') as f:
+            mpe = MultipartEncoder(fields={'metadata': metadata_json, 'file': (archive.filename, f)})
+            resp = self.fw_api.post('upload/uid', data=mpe, headers={'Content-Type': mpe.content_type})
+            resp.raise_for_status()
+
+
+def iter_multipart_upload(boundary, metadata_json, archive):
+    yield ('--{0}\r\nContent-Disposition: form-data; name="metadata"\r\n\r\n'.format(boundary)).encode('utf-8')
+    yield metadata_json.encode('utf-8')
+    yield ('\r\n--{0}\r\nContent-Disposition: form-data; name="file"; filename="{1}"\r\n'
+           'Content-Type: application/zip\r\n\r\n'.format(boundary, archive.filename)).encode('utf-8')
+    for chunk in archive.iter_zip():
+        if chunk:  # an empty chunk would terminate the chunked transfer
+            yield chunk
+    yield '\r\n--{0}--\r\n'.format(boundary).encode('utf-8')
+
+
+def import_hl7_messages(hc_api, hc_hl7store, hl7_ids, fw_api, fw_project, subjects=None, master_codes=None,
+                        config=None, journal=None, imported=None, shard=None):
+    log.info('Importing HL7 messages...')
+    config = config or {}
+    journal = journal or ImportJournal()
+    shard = shard or Shard()
+    subjects = subjects or SubjectIndex(fw_api, fw_project)
+    master_codes = master_codes or MasterCodeResolver(fw_api)
+    uploader = LabelUploader(fw_api, 'hl7', subjects, journal, config=config)
+    hl7_ids = (msg_id for msg_id in hl7_ids if not is_imported(journal, None, 'hl7', msg_id, shard=shard))
+    fetched = prefetch(functools.partial(get_hl7_message, hc_api, hc_hl7store), hl7_ids,
+                       workers=config.get('hl7_fetch_workers', HL7_FETCH_WORKERS), window=PREFETCH_CHUNK_SIZE)
+    for chunk in chunked(fetched, PREFETCH_CHUNK_SIZE):
+        messages = [(msg_id, msg, HL7Message(msg)) for msg_id, msg in chunk]
+        # the file name is only known once the message is parsed
+        messages = [(msg_id, msg, msg_obj) for msg_id, msg, msg_obj in messages
+                    if shard.owns('hl7', msg_id, msg_obj.patient_id) and
+                    not is_imported(journal, imported, 'hl7', msg_id, filename=msg_obj.msg_control_id + '.hl7.txt')]
+        master_codes.prefetch((get_subject_code_payload(msg_obj) for _, _, msg_obj in messages), 'hl7')
+
+        for msg_id, msg, msg_obj in messages:
+            import_hl7_message(msg_id, msg, msg_obj, uploader, fw_project, subjects, master_codes)
+    uploader.flush_all()
+    master_codes.log_stats()
+
+
+def get_hl7_message(hc_api, hc_hl7store, msg_id):
+    log.info('  Fetching HL7 message %s', msg_id)
+    with METRICS.timer('fetch', 'hl7') as sample:
+        msg = retry_call(hc_api.hl7V2Stores.messages.get, name='{}/messages/{}'.format(hc_hl7store, msg_id))
+        sample.bytes = len(msg.get('data', ''))
+    return msg
+
+
+def import_hl7_message(msg_id, msg, msg_obj, uploader, fw_project, subjects, master_codes):
+    log.info('  Processing HL7 message %s', msg_obj.msg_control_id)
+    log.debug('     Creating metadata...')
+    master_subject_code = master_codes.get(get_subject_code_payload(msg_obj), 'hl7')
+    subject = subjects.get(master_subject_code, 'hl7')
+
+    # the raw message goes up as the file, it's left out of the file info
+    file_meta = normalize_dict_keys(msg, exclude=('data',))
+
+    metadata = get_metadata(msg_obj)
+    set_upload_containers(metadata, fw_project, master_subject_code, subject, HL7_SUBJECT_FIELDS)
+    metadata['acquisition']['files'] = [
+        {
+            'name': msg_obj.msg_control_id + '.hl7.txt',
+            'type': 'hl7',
+            'info': file_meta
         }
+    ]
 
-        master_subject_code = get_master_subject_code(subj_code_payload, fw_api)
+    log.debug('     Upload metadata:\n%s', LazyPformat(metadata))
+    uploader.add(msg_id, metadata, msg_obj.msg_control_id + '.hl7.txt', base64.b64decode(msg['data']))
 
-        log.debug(master_subject_code)
-        subject = get_subject_by_master_code(master_subject_code, fw_project, fw_api)
 
-        metadata = get_metadata(resource_obj)
-        metadata.setdefault('group', {})['_id'] = fw_project['group']
-        metadata.setdefault('project', {})['label'] = fw_project['label']
-        subject_info = copy.deepcopy(metadata['session']['subject'])
-        metadata['session']['subject'] = {'master_code': master_subject_code}
-        collection = metadata['session']['subject'] if resource_type == 'Patient' else metadata['session'] if resource_type == 'Encounter' else metadata['acquisition']
-        filename = resource_type.lower() if resource_type in ['Patient', 'Encounter'] else resource['id']
-        collection['files'] = [
-            {
-                'name': filename + '.fhir.json',
-                'type': 'fhir',
-                'info': {'fhir': resource, **resource_obj.extra_info}
-            }
-        ]
-
-        if resource_type in ['Patient', 'Encounter']:
-            del metadata['acquisition']
-
-        for key in ('code', 'firstname', 'lastname', 'sex', 'type'):
-            if not (subject and subject.get(key)) and subject_info.get(key):
-                metadata['session']['subject'][key] = subject_info[key]
+def import_fhir_resources(hc_api, hc_fhirstore, fhir_refs, fw_api, fw_project, subjects=None, master_codes=None,
+                          config=None, journal=None, imported=None, shard=None):
+    log.info('Importing FHIR resources...')
+    config = config or {}
+    journal = journal or ImportJournal()
+    shard = shard or Shard()
+    subjects = subjects or SubjectIndex(fw_api, fw_project)
+    master_codes = master_codes or MasterCodeResolver(fw_api)
+    patients = FHIRPatientCache(hc_api, hc_fhirstore)
+    uploader = LabelUploader(fw_api, 'fhir', subjects, journal, config=config)
+    payload = FHIRPayload(config.get('fhir_payload_mode', 'full'), config.get('fhir_info_fields', FHIR_INFO_FIELDS))
+    fhir_refs = (ref for ref in fhir_refs if not is_imported(journal, None, 'fhir', ref, shard=shard))
+    errors = {}
+    batches = prefetch(functools.partial(read_fhir_resources, hc_api, hc_fhirstore, errors=errors),
+                       chunked(fhir_refs, config.get('fhir_batch_size', FHIR_BATCH_SIZE)),
+                       workers=config.get('fhir_fetch_workers', FHIR_FETCH_WORKERS))
+    for refs, batch in batches:
+        # resources that couldn't be read were logged and left out of the batch, only transient
+        # failures are worth another try
+        for resource_ref in set(refs).difference(resource_ref for resource_ref, _ in batch):
+            if errors.pop(resource_ref, True):
+                journal.fail('fhir', resource_ref)
+            else:
+                journal.skip('fhir', resource_ref)
+        fetched = []
+        for resource_ref, resource in batch:
+            resource_type = resource_ref.split('/')[0]
+            # patients and encounters are stored on the subject/session, only acquisition files are checked
+            filename = resource['id'] + '.fhir.json' if resource_type not in ['Patient', 'Encounter'] else None
+            if is_imported(journal, imported, 'fhir', resource_ref, filename=filename):
+                continue
+            fetched.append((resource_ref, resource_type, resource))
+            if resource['resourceType'] == 'Patient':
+                patients.add(resource)
+        patients.prefetch(get_fhir_patient_id(resource) for _, _, resource in fetched)
+        resources = [(resource_ref, resource_type, resource,
+                      FHIRResource(resource, hc_api, hc_fhirstore, patients=patients))
+                     for resource_ref, resource_type, resource in fetched]
+        for resource_ref, _, resource, resource_obj in resources:
+            if resource_obj.patient_id is None:
+                # no subject, a subject that isn't a patient, or a patient that couldn't be read
+                patient_id = get_fhir_patient_id(resource)
+                if patient_id and patients.failed_transiently(patient_id):
+                    journal.fail('fhir', resource_ref)
+                else:
+                    journal.skip('fhir', resource_ref)
+        resources = [(resource_ref, resource_type, resource, resource_obj)
+                     for resource_ref, resource_type, resource, resource_obj in resources
+                     if resource_obj.patient_id is not None and
+                     shard.owns('fhir', resource_ref, resource_obj.patient_id)]
+        master_codes.prefetch((get_subject_code_payload(resource_obj) for _, _, _, resource_obj in resources), 'fhir')
+
+        for resource_ref, resource_type, resource, resource_obj in resources:
+            import_fhir_resource(resource_ref, resource_type, resource, resource_obj, uploader, fw_project, subjects,
+                                 master_codes, payload)
+    uploader.flush_all()
+    master_codes.log_stats()
+
+
+def import_fhir_resource(resource_ref, resource_type, resource, resource_obj, uploader, fw_project, subjects,
+                         master_codes, payload=None):
+    log.info('  Processing FHIR resource %s/%s', resource_type, resource['id'])
+    log.debug('     Creating metadata...')
+    master_subject_code = master_codes.get(get_subject_code_payload(resource_obj), 'fhir')
+    log.debug(master_subject_code)
+    subject = subjects.get(master_subject_code, 'fhir')
+    payload = payload or FHIRPayload()
+
+    metadata = get_metadata(resource_obj)
+    set_upload_containers(metadata, fw_project, master_subject_code, subject, FHIR_SUBJECT_FIELDS)
+    collection = metadata['session']['subject'] if resource_type == 'Patient' else metadata['session'] if resource_type == 'Encounter' else metadata['acquisition']
+    filename = resource_type.lower() if resource_type in ['Patient', 'Encounter'] else resource['id']
+    collection['files'] = [
+        {
+            'name': filename + '.fhir.json',
+            'type': 'fhir',
+            'info': {'fhir': payload.get_info(resource), **resource_obj.extra_info}
+        }
+    ]
+
+    if resource_type in ['Patient', 'Encounter']:
+        del metadata['acquisition']
+
+    log.debug('     Upload metadata:\n%s', LazyPformat(metadata))
+    uploader.add(resource_ref, metadata, filename + '.fhir.json', payload.get_body(resource))
+
+
+class FHIRPayload:
+    # full: the whole resource in the file info and a pretty printed file. compact: only the
+    # info_fields of the resource in the info and the file serialized without whitespace, which
+    # also keeps json on its C encoder (indent falls back to the pure python one).
+    def __init__(self, mode='full', info_fields=FHIR_INFO_FIELDS):
+        if mode not in FHIR_PAYLOAD_MODES:
+            raise ValueError('Invalid FHIR payload mode {!r}, expected one of {}'.format(mode, FHIR_PAYLOAD_MODES))
+        self.mode = mode
+        self.info_fields = [field.strip() for field in info_fields.split(',') if field.strip()]
+
+    def get_info(self, resource):
+        if self.mode == 'full':
+            return resource
+        return {field: resource[field] for field in self.info_fields if field in resource}
+
+    def get_body(self, resource):
+        if self.mode == 'full':
+            return json.dumps(resource, sort_keys=True, indent=4, default=metadata_encoder).encode('utf-8')
+        return json.dumps(resource, sort_keys=True, separators=(',', ':'), default=metadata_encoder).encode('utf-8')
+
+
+def plan_import(context, hc_api, config, journal, imported, shard, sync=None):
+    log.info('Planning import (dry run)...')
+    plan = ImportPlan(os.path.join(context.output_dir, PLAN_FILENAME),
+                      max_series_in_flight=config.get('dicom_max_series_in_flight', DICOM_MAX_SERIES_IN_FLIGHT))
+    try:
+        dicom_refs = get_object_references(context, hc_api, config, sync, 'dicoms')
+        if dicom_refs is not None:
+            plan_dicom_files(hc_api, config['hc_dicomstore'], dicom_refs, plan, config, journal, imported, shard)
+
+        hl7_refs = get_object_references(context, hc_api, config, sync, 'hl7s')
+        if hl7_refs is not None:
+            plan_hl7_messages(hc_api, config['hc_hl7store'], hl7_refs, plan, config, journal, imported, shard)
+
+        fhir_refs = get_object_references(context, hc_api, config, sync, 'fhirs')
+        if fhir_refs is not None:
+            plan_fhir_resources(hc_api, config['hc_fhirstore'], fhir_refs, plan, config, journal, imported, shard)
+    finally:
+        plan.close()
+    summary = plan.get_summary()
+    with open(os.path.join(context.output_dir, PLAN_SUMMARY_FILENAME), 'w') as f:
+        json.dump(summary, f, indent=2)
+    plan.log_summary(summary)
+
+
+def plan_dicom_files(hc_api, hc_dicomstore, dcm_ids, plan, config, journal, imported, shard):
+    dicomweb = get_dicomweb(hc_api, hc_dicomstore)
+    workers = config.get('dicom_search_workers', DICOM_SEARCH_WORKERS)
+    series_uids = ((study_uid, series_uid) for study_uid, series_uid, patient_id
+                   in search_uids(dicomweb, dcm_ids, workers=workers)
+                   if shard.owns('dicom', series_uid, patient_id) and
+                   not is_imported(journal, imported, 'dicom', series_uid, series_uid=series_uid))
+    for (study_uid, series_uid), instances in prefetch(functools.partial(search_series_instances, dicomweb),
+                                                       series_uids, workers=workers):
+        first = instances[0] if instances else {}
+        plan.add('dicom', series_uid,
+                 patient_id=get_dicom_json_value(first, 'PatientID'),
+                 session=study_uid,
+                 acquisition=series_uid,
+                 instances=len(instances),
+                 nbytes=sum(estimate_instance_size(instance) for instance in instances),
+                 modality=get_dicom_json_value(first, 'Modality'),
+                 description=get_dicom_json_value(first, 'SeriesDescription'))
+
+
+def search_series_instances(dicomweb, series):
+    study_uid, series_uid = series
+    instances = []
+    while True:
+        page = retry_call(dicomweb.search_for_instances, study_uid, series_uid, fields=list(PLAN_INSTANCE_TAGS),
+                          limit=PLAN_PAGE_SIZE, offset=len(instances))
+        instances.extend(page)
+        if len(page) < PLAN_PAGE_SIZE:
+            return instances
+
+
+def get_dicom_json_value(dataset, keyword, default=None):
+    values = dataset.get(PLAN_INSTANCE_TAGS[keyword], {}).get('Value')
+    return values[0] if values else default
+
+
+def estimate_instance_size(instance):
+    # uncompressed pixel data plus a typical header, compressed transfer syntaxes come out smaller
+    frame_size = (int(get_dicom_json_value(instance, 'Rows', 0)) * int(get_dicom_json_value(instance, 'Columns', 0)) *
+                  ((int(get_dicom_json_value(instance, 'BitsAllocated', 8)) + 7) // 8) *
+                  int(get_dicom_json_value(instance, 'SamplesPerPixel', 1)))
+    return frame_size * int(get_dicom_json_value(instance, 'NumberOfFrames', 1)) + DICOM_HEADER_SIZE_ESTIMATE
+
+
+def plan_hl7_messages(hc_api, hc_hl7store, hl7_ids, plan, config, journal, imported, shard):
+    hl7_ids = (msg_id for msg_id in hl7_ids if not is_imported(journal, None, 'hl7', msg_id, shard=shard))
+    fetched = prefetch(functools.partial(get_hl7_message, hc_api, hc_hl7store), hl7_ids,
+                       workers=config.get('hl7_fetch_workers', HL7_FETCH_WORKERS), window=PREFETCH_CHUNK_SIZE)
+    for msg_id, msg in fetched:
+        msg_obj = HL7Message(msg)
+        filename = msg_obj.msg_control_id + '.hl7.txt'
+        if not shard.owns('hl7', msg_id, msg_obj.patient_id):
+            continue
+        if is_imported(journal, imported, 'hl7', msg_id, filename=filename):
+            continue
+        metadata = get_metadata(msg_obj)
+        plan.add('hl7', msg_id,
+                 patient_id=msg_obj.patient_id,
+                 session=metadata['session'].get('label'),
+                 acquisition=metadata['acquisition'].get('label'),
+                 nbytes=len(base64.b64decode(msg['data'])),
+                 filename=filename)
+
+
+def plan_fhir_resources(hc_api, hc_fhirstore, fhir_refs, plan, config, journal, imported, shard):
+    patients = FHIRPatientCache(hc_api, hc_fhirstore)
+    payload = FHIRPayload(config.get('fhir_payload_mode', 'full'), config.get('fhir_info_fields', FHIR_INFO_FIELDS))
+    fhir_refs = (ref for ref in fhir_refs if not is_imported(journal, None, 'fhir', ref, shard=shard))
+    batches = prefetch(functools.partial(read_fhir_resources, hc_api, hc_fhirstore),
+                       chunked(fhir_refs, config.get('fhir_batch_size', FHIR_BATCH_SIZE)),
+                       workers=config.get('fhir_fetch_workers', FHIR_FETCH_WORKERS))
+    for _, batch in batches:
+        for _, resource in batch:
+            if resource['resourceType'] == 'Patient':
+                patients.add(resource)
+        patients.prefetch(get_fhir_patient_id(resource) for _, resource in batch)
+        for resource_ref, resource in batch:
+            resource_type = resource_ref.split('/')[0]
+            filename = resource['id'] + '.fhir.json' if resource_type not in ['Patient', 'Encounter'] else None
+            resource_obj = FHIRResource(resource, hc_api, hc_fhirstore, patients=patients)
+            if resource_obj.patient_id is None or not shard.owns('fhir', resource_ref, resource_obj.patient_id):
+                continue
+            if is_imported(journal, imported, 'fhir', resource_ref, filename=filename):
+                continue
+            metadata = get_metadata(resource_obj)
+            plan.add('fhir', resource_ref,
+                     patient_id=resource_obj.patient_id,
+                     session=metadata['session'].get('label'),
+                     acquisition=metadata.get('acquisition', {}).get('label') if filename else None,
+                     nbytes=len(payload.get_body(resource)),
+                     filename=filename or resource_type.lower() + '.fhir.json')
+
+
+class ImportPlan:
+    # dry run output: one JSON line per unit that would be imported, and totals per kind
+    def __init__(self, path=None, max_series_in_flight=DICOM_MAX_SERIES_IN_FLIGHT):
+        self.file = open(path, 'w') if path else None
+        self.max_series_in_flight = max(1, max_series_in_flight)
+        self.totals = collections.OrderedDict()
+        self.largest_series = []
+
+    def add(self, kind, ref, patient_id=None, session=None, acquisition=None, instances=0, nbytes=0, **extra):
+        entry = collections.OrderedDict([('type', kind), ('id', ref), ('patient_id', patient_id),
+                                         ('session', session), ('acquisition', acquisition),
+                                         ('instances', instances), ('bytes', nbytes)])
+        entry.update(extra)
+        if self.file is not None:
+            self.file.write(json.dumps(entry, default=metadata_encoder) + '\n')
+        totals = self.totals.setdefault(kind, {'units': 0, 'instances': 0, 'bytes': 0, 'patients': set(),
+                                               'sessions': set(), 'acquisitions': set()})
+        totals['units'] += 1
+        totals['instances'] += instances
+        totals['bytes'] += nbytes
+        if patient_id:
+            totals['patients'].add(patient_id)
+        if session:
+            totals['sessions'].add((patient_id, session))
+        if acquisition:
+            totals['acquisitions'].add((patient_id, session, acquisition))
+        if kind == 'dicom':
+            # the series in flight at once bound the temp storage a run needs
+            heapq.heappush(self.largest_series, (nbytes, instances))
+            if len(self.largest_series) > self.max_series_in_flight:
+                heapq.heappop(self.largest_series)
+
+    def get_summary(self):
+        summary = collections.OrderedDict()
+        for kind, totals in self.totals.items():
+            summary[kind] = collections.OrderedDict(
+                (key, len(value) if isinstance(value, set) else value) for key, value in totals.items())
+        if self.largest_series:
+            largest_bytes, largest_instances = max(self.largest_series)
+            summary['dicom']['largest_series_bytes'] = largest_bytes
+            summary['dicom']['largest_series_instances'] = largest_instances
+            summary['dicom']['estimated_temp_bytes'] = sum(nbytes for nbytes, _ in self.largest_series)
+        return summary
+
+    def log_summary(self, summary):
+        lines = ['{:<6} {:>10} {:>9} {:>9} {:>12} {:>12} {:>12}'.format(
+            'kind', 'units', 'patients', 'sessions', 'acquisitions', 'instances', 'MB')]
+        for kind, totals in summary.items():
+            lines.append('{:<6} {:>10} {:>9} {:>9} {:>12} {:>12} {:>12.1f}'.format(
+                kind, totals['units'], totals['patients'], totals['sessions'], totals['acquisitions'],
+                totals['instances'], totals['bytes'] / 1e6))
+        if 'estimated_temp_bytes' in summary.get('dicom', {}):
+            lines.append('Largest DICOM series: {:.1f} MB, temp storage for {} series in flight: {:.1f} MB'.format(
+                summary['dicom']['largest_series_bytes'] / 1e6, self.max_series_in_flight,
+                summary['dicom']['estimated_temp_bytes'] / 1e6))
+        log.info('Import plan:\n%s', '\n'.join(lines))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def upload_label(fw_api, metadata_json, files):
+    fields = [('metadata', metadata_json)] + [('file', (filename, data)) for filename, data in files]
+    mpe = MultipartEncoder(fields=fields)
+    resp = fw_api.post('upload/label', data=mpe, headers={'Content-Type': mpe.content_type})
+    log.debug('     Upload response:\n%s', LazyPformat(resp.json))
+    resp.raise_for_status()
 
-        log.debug('     Upload metadata:\n%s', pprint.pformat(metadata))
-        log.debug('     Uploading...')
 
-        metadata_json = json.dumps(metadata, default=metadata_encoder)
-        msg_json = json.dumps(resource, sort_keys=True, indent=4, default=metadata_encoder)
-        mpe = MultipartEncoder(fields={'metadata': metadata_json, 'file': (filename + '.fhir.json', msg_json)})
-        resp = fw_api.post('upload/label', data=mpe, headers={'Content-Type': mpe.content_type})
-        log.debug('     Upload response:\n%s', pprint.pformat(resp.json()))
-        resp.raise_for_status()
+class LabelUploader:
+    # batches the upload/label files of a subject/session/acquisition into one request with merged
+    # metadata, groups are flushed when full, when pending for too long or at the end of the import
+    def __init__(self, fw_api, kind, subjects, journal, config=None):
+        config = config or {}
+        self.fw_api = fw_api
+        self.kind = kind
+        self.subjects = subjects
+        self.journal = journal
+        self.batch_size = max(1, config.get('upload_batch_size', UPLOAD_BATCH_SIZE))
+        self.max_bytes = config.get('upload_batch_mb', UPLOAD_BATCH_MB) * 1024 * 1024
+        self.max_wait = config.get('upload_batch_seconds', UPLOAD_BATCH_SECONDS)
+        self.groups = collections.OrderedDict()
+        self.pending_bytes = 0
+
+    @staticmethod
+    def get_group_key(metadata):
+        return (metadata['session']['subject'].get('master_code'), metadata['session'].get('label'),
+                metadata.get('acquisition', {}).get('label'))
+
+    def add(self, key, metadata, filename, data):
+        group_key = self.get_group_key(metadata)
+        group = self.groups.get(group_key)
+        if group is not None and filename in group.files:
+            # a file replacing one of the same batch has to go in a later request
+            self.flush(group_key)
+            group = None
+        if group is None:
+            group = self.groups[group_key] = types.SimpleNamespace(
+                keys=[], metadata={}, files=collections.OrderedDict(), size=0, started=time.monotonic())
+        group.keys.append(key)
+        merge_metadata(group.metadata, metadata)
+        group.files[filename] = data
+        group.size += len(data)
+        self.pending_bytes += len(data)
+        if len(group.files) >= self.batch_size or group.size >= self.max_bytes:
+            self.flush(group_key)
+        self.flush_expired()
+
+    def flush_expired(self):
+        # groups are ordered by creation, the oldest ones go first when over the time or memory limit
+        while self.groups:
+            group_key, group = next(iter(self.groups.items()))
+            if time.monotonic() - group.started < self.max_wait and self.pending_bytes <= self.max_bytes:
+                break
+            self.flush(group_key)
+
+    def flush(self, group_key):
+        group = self.groups.pop(group_key)
+        self.pending_bytes -= group.size
+        log.info('  Uploading %s %s files to %s', len(group.files), self.kind.upper(),
+                 '/'.join(str(label) for label in group_key if label is not None))
+        # uploads of other groups may have set subject fields since the metadata was built
+        subject = group.metadata['session']['subject']
+        existing = self.subjects.get(subject['master_code'], self.kind)
+        for key in [key for key in subject if key != 'master_code' and existing and existing.get(key)]:
+            del subject[key]
+        metadata_json = json.dumps(group.metadata, default=metadata_encoder)
+        with METRICS.timer('upload', self.kind, nbytes=group.size, count=len(group.files)):
+            retry_call(upload_label, self.fw_api, metadata_json, list(group.files.items()))
+        self.subjects.update(subject['master_code'], subject)
+        for key in group.keys:
+            self.journal.record(self.kind, key)
+
+    def flush_all(self):
+        while self.groups:
+            self.flush(next(iter(self.groups)))
+
+
+def merge_metadata(merged, metadata, keep_first=False):
+    # same as uploading the metadata one after the other: later values win and the file lists add up,
+    # except for the subject fields which only fill what the subject is missing, so the first one wins
+    for key, value in metadata.items():
+        if key == 'files':
+            merged.setdefault(key, []).extend(value)
+        elif isinstance(value, dict):
+            merge_metadata(merged.setdefault(key, {}), value, keep_first=keep_first or key == 'subject')
+        elif not (keep_first and merged.get(key)):
+            merged[key] = value
+
+
+def get_subject_code_payload(obj):
+    return {
+        'patient_id': obj.patient_id,
+        'first_name': obj.subject_firstname,
+        'last_name': obj.subject_lastname,
+        'date_of_birth': obj.dob.strftime('%Y-%m-%d'),
+        'use_patient_id': bool(obj.patient_id)
+    }
 
 
 def get_master_subject_code(payload, fw_api):
     payload_json = json.dumps(payload, default=metadata_encoder)
-    log.debug('  Master subject code payload:\n%s', pprint.pformat(payload))
+    log.debug('  Master subject code payload:\n%s', LazyPformat(payload))
     resp = fw_api.post('subjects/master-code', data=payload_json)
-    log.debug('  Master subject code response:\n%s', pprint.pformat(resp.json()))
+    log.debug('  Master subject code response:\n%s', LazyPformat(resp.json))
     resp.raise_for_status()
     return resp.json()['code']
 
 
-def get_subject_by_master_code(code, fw_project, fw_api):
-    resp = fw_api.get('subjects')
-    resp.raise_for_status()
-    matching_subjects = [s for s in resp.json() if s.get('master_code') == code and s['project'] == fw_project['_id']]
+def prefetch(func, items, workers=1, window=None):
+    # yields (item, func(item)) in input order while up to `window` calls run ahead on a thread pool
+    window = max(window or workers, workers)
+    pending = collections.deque()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= window:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def retry_call(func, *args, **kwargs):
+    # calls func in a concurrency limiter slot, requests made inside share the slot and are not retried again
+    limiter = TRANSPORT.limiter
+    for attempt in range(TRANSPORT.retries):
+        try:
+            with limiter.slot():
+                return func(*args, **kwargs)
+        except Exception as exc:
+            if get_error_status(exc) in THROTTLE_STATUS_CODES:
+                limiter.feedback(throttled=True)
+            if attempt == TRANSPORT.retries - 1 or not is_transient_error(exc):
+                raise
+            delay = get_retry_delay(attempt, get_error_retry_after(exc))
+            log.warning('  %s, retrying in %.1fs', exc, delay)
+            time.sleep(delay)
+
+
+def is_transient_error(exc):
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return get_error_status(exc) in TRANSIENT_STATUS_CODES
+
+
+def get_error_response(exc):
+    # requests.HTTPError carries .response, googleapiclient's HttpError carries .resp
+    # (an error requests.Response is falsy, so no `or` here)
+    response = getattr(exc, 'response', None)
+    return response if response is not None else getattr(exc, 'resp', None)
+
+
+def get_error_status(exc):
+    response = get_error_response(exc)
+    status = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
 
-    if len(matching_subjects) > 1:
-        raise Exception("Too many matching study, can't decide what to do")
-    elif len(matching_subjects) == 1:
-        return matching_subjects[0]
 
-    return None
+def get_error_retry_after(exc):
+    # httplib2 responses are dicts of lower-cased headers
+    response = get_error_response(exc)
+    headers = getattr(response, 'headers', response)
+    try:
+        return headers.get('Retry-After') or headers.get('retry-after')
+    except AttributeError:
+        return None
 
 
-def normalize_dict_keys(d):
-    new = {}
-    for k, v in d.items():
-        if isinstance(v, dict):
-            v = normalize_dict_keys(v)
-        elif isinstance(v, list):
-            sub_list = []
-            for i in v:
-                sub_list.append(normalize_dict_keys(i))
-            v = sub_list
-
-        new[k.replace('.', '_')] = v
-    return new
-
-
-def search_uids(dicomweb, uids):
-    series_set = set()
-    for uid in uids:
-        log.info('  Searching studies and series with UID %s', uid)
-        for uid_field in ('StudyInstanceUID', 'SeriesInstanceUID'):
-            for series in dicomweb.search_for_series(search_filters={uid_field: uid}):
-                dataset = load_json_dataset(series)
-                series_set.add((dataset.StudyInstanceUID, dataset.SeriesInstanceUID))
-    return sorted(series_set)
-
-
-def pkg_series(path, **kwargs):
-    acquisitions = {}
-    for filename, filepath in [(filename, os.path.join(path, filename)) for filename in os.listdir(path)]:
-        dcm = DicomFile(filepath, parse=True, **kwargs)
-        if dcm.acq_no not in acquisitions:
-            arcdir_path = os.path.join(path, '..', dcm.acquisition_uid + '.dicom')
-            os.mkdir(arcdir_path)
-            metadata = get_metadata(dcm)
-            metadata['patient_id'] = dcm.get('PatientID')
-            acquisitions[dcm.acq_no] = arcdir_path, metadata
+def get_retry_delay(attempt, retry_after=None):
+    # full jitter exponential backoff, but never sooner than the server asked for
+    delay = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+    if retry_after:
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            try:
+                date = email.utils.parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                return delay
+            wait = (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        delay = max(delay, min(wait, RETRY_AFTER_MAX))
+    return delay
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def normalize_dict_keys(d, exclude=()):
+    # copies the containers while replacing dots in the keys, which Flywheel info can't store
+    return {(k.replace('.', '_') if '.' in k else k): normalize_value(v) for k, v in d.items() if k not in exclude}
+
+
+def normalize_value(value):
+    if isinstance(value, dict):
+        return normalize_dict_keys(value)
+    elif isinstance(value, list):
+        return [normalize_value(item) for item in value]
+    return value
+
+
+def search_uids(dicomweb, uids, workers=1):
+    # yields (study_uid, series_uid, patient_id) as the searches complete, input UIDs and series found
+    # through more than one UID are only processed once
+    seen_uids = set()
+    seen_series = set()
+    unique_uids = (uid for uid in uids if not (uid in seen_uids or seen_uids.add(uid)))
+    for _, found in prefetch(functools.partial(search_uid, dicomweb), unique_uids, workers=workers):
+        for series in sorted(found, key=lambda series: series[:2]):
+            if series[1] not in seen_series:
+                seen_series.add(series[1])
+                yield series
+
+
+def search_uid(dicomweb, uid):
+    log.info('  Searching studies and series with UID %s', uid)
+    for uid_field in UID_SEARCH_FIELDS:
+        found = set()
+        with METRICS.timer('search', 'dicom'):
+            matches = retry_call(dicomweb.search_for_series, search_filters={uid_field: uid},
+                                 fields=list(SERIES_SEARCH_TAGS))
+        for series in matches:
+            found.add(tuple(series.get(tag, {}).get('Value', [None])[0] for tag in SERIES_SEARCH_TAGS.values()))
+        # a UID is either a study or a series, no need to search series once the study matched
+        if found:
+            return found
+    return set()
+
+
+def pkg_series(path, stream=False, compressor=None, parse_executor=None, **kwargs):
+    packager = SeriesPackager(os.path.dirname(path), stream=stream, compressor=compressor)
+    filenames = sorted(os.listdir(path))
+    filepaths = [os.path.join(path, filename) for filename in filenames]
+    parse = functools.partial(parse_instance, **kwargs)
+    if parse_executor is not None:
+        # map yields in submission order, grouping matches the serial path
+        instances = parse_executor.map(parse, filepaths, chunksize=PARSE_CHUNK_SIZE)
+    else:
+        instances = map(parse, filepaths)
+    try:
+        for filename, filepath, instance in zip(filenames, filepaths, instances):
+            packager.add(filepath, filename, instance)
+    except Exception:
+        packager.abort()
+        raise
+    return packager.close()
+
+
+ParsedInstance = collections.namedtuple(
+    'ParsedInstance',
+    ['acq_no', 'acquisition_uid', 'acquisition_timestamp', 'transfer_syntax', 'metadata', 'parse_seconds'])
+
+
+def parse_instance(filepath, **kwargs):
+    # parses (and de-identifies) one instance, runs in the parse process pool so it reports its own timing
+    start = time.perf_counter()
+    dcm = DicomFile(filepath, parse=True, **kwargs)
+    metadata = get_metadata(dcm)
+    metadata['patient_id'] = dcm.get('PatientID')
+    return ParsedInstance(dcm.acq_no, dcm.acquisition_uid, dcm.acquisition_timestamp, get_transfer_syntax(dcm), metadata,
+                          time.perf_counter() - start)
+
+
+class SeriesPackager:
+    # routes each parsed instance into an open zip archive per acquisition, or in stream mode only
+    # groups them so that the zip can be generated during the upload
+    def __init__(self, outdir, stream=False, compressor=None):
+        self.outdir = outdir
+        self.stream = stream
+        self.compressor = compressor or MemberCompressor()
+        self.archives = {}
+
+    def add(self, filepath, filename, instance):
+        METRICS.record('parse', 'dicom', instance.parse_seconds, nbytes=os.path.getsize(filepath))
+        if instance.acq_no not in self.archives:
+            arc_name = instance.acquisition_uid + '.dicom'
+            metadata = instance.metadata
+            metadata['acquisition']['files'] = [{'name': arc_name + '.zip', 'type': 'dicom'}]
+            archive = DicomArchive(arc_name, os.path.join(self.outdir, arc_name + '.zip'), metadata, self.compressor)
+            if not self.stream:
+                archive.open()
+            self.archives[instance.acq_no] = archive
+        archive = self.archives[instance.acq_no]
         if filename.startswith('(none)'):
             filename = filename.replace('(none)', 'NA')
-        file_time = max(int(dcm.acquisition_timestamp.strftime('%s')), 315561600)  # zip can't handle < 1980
-        os.utime(filepath, (file_time, file_time))  # correct timestamps
-        os.rename(filepath, '%s.dcm' % os.path.join(acquisitions[dcm.acq_no][0], filename))
-    metadata_map = {}
-    for arcdir_path, metadata in acquisitions.values():
-        arc_name = os.path.basename(arcdir_path)
-        metadata['acquisition']['files'] = [{'name': arc_name + '.zip', 'type': 'dicom'}]
-        arc_path = create_archive(arcdir_path, arc_name, metadata=metadata)
-        shutil.rmtree(arcdir_path)
-        metadata_map[arc_path] = metadata
-    return metadata_map
-
-
-def get_metadata(dcm):
-    metadata = {}
-    for group in ('subject', 'session', 'acquisition'):
-        prefix = group + '_'
-        group_attrs = [attr for attr in dir(dcm) if attr.startswith(prefix) and getattr(dcm, attr)]
-        metadata[group] = {k.replace(prefix, ''): getattr(dcm, k) for k in group_attrs}
+        zinfo = zipfile.ZipInfo(os.path.join(archive.arc_name, filename + '.dcm'),
+                                date_time=get_zip_date_time(instance.acquisition_timestamp))
+        zinfo.compress_type = self.compressor.get_compress_type(instance.transfer_syntax)
+        zinfo.external_attr = 0o644 << 16
+        zinfo.file_size = os.path.getsize(filepath)
+        archive.add(filepath, zinfo)
+
+    def close(self):
+        archives = list(self.archives.values())
+        for archive in archives:
+            archive.close()
+        self.archives = {}
+        return archives
+
+    def abort(self):
+        for archive in self.archives.values():
+            archive.discard()
+        self.archives = {}
+
+
+class DicomArchive:
+    def __init__(self, arc_name, path, metadata, compressor=None):
+        self.arc_name = arc_name
+        self.path = path
+        self.metadata = metadata
+        self.compressor = compressor or MemberCompressor()
+        self.comment = None
+        self.size = 0
+        self.members = []
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.zf = None
+
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
+
+    def open(self):
+        self.zf = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def add(self, filepath, zinfo):
+        if self.zf is None:
+            self.members.append((filepath, zinfo))
+            return
+        self.submit(filepath, zinfo)
+        while self.pending_bytes > self.compressor.window_bytes:
+            self.write_pending(self.zf, remove=True)
+
+    def submit(self, filepath, zinfo):
+        self.pending.append((filepath, zinfo, self.compressor.submit(filepath, zinfo)))
+        self.pending_bytes += zinfo.file_size
+
+    def write_pending(self, zf, remove=False):
+        filepath, zinfo, future = self.pending.popleft()
+        self.pending_bytes -= zinfo.file_size
+        self.compressor.write(zf, filepath, zinfo, future)
+        if remove:
+            os.remove(filepath)  # archived, release the temp space right away
+
+    def close(self):
+        # snapshot the metadata at packing time, the upload mutates it
+        self.comment = json.dumps(self.metadata, default=metadata_encoder).encode('utf-8')
+        if self.zf is not None:
+            while self.pending:
+                self.write_pending(self.zf, remove=True)
+            self.zf.comment = self.comment
+            self.zf.close()
+            self.zf = None
+            self.size = os.path.getsize(self.path)
+
+    def cancel_pending(self):
+        for _, _, future in self.pending:
+            if future is not None:
+                future.cancel()
+        self.pending.clear()
+        self.pending_bytes = 0
+
+    def discard(self):
+        self.cancel_pending()
+        if self.zf is not None:
+            self.zf.close()
+            self.zf = None
+            os.remove(self.path)
+
+    @property
+    def member_bytes(self):
+        # about the most an archive saved from the members takes on disk
+        return sum(zinfo.file_size for _, zinfo in self.members)
+
+    def remove_files(self):
+        # removes the uploaded archive and its members
+        for filepath in [filepath for filepath, _ in self.members] + [self.path]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    def save(self):
+        with open(self.path, 'wb') as f:
+            for chunk in self.iter_zip():
+                f.write(chunk)
+
+    def iter_zip(self):
+        # generate the zip from the pending members without an intermediate archive file,
+        # starting over if a previous upload attempt was interrupted
+        self.cancel_pending()
+        self.size = 0
+        sink = ChunkSink()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            members = iter(self.members)
+            while True:
+                for filepath, zinfo in members:
+                    self.submit(filepath, zinfo)
+                    if self.pending_bytes > self.compressor.window_bytes:
+                        break
+                if not self.pending:
+                    break
+                self.write_pending(zf)
+                if sink.size >= STREAM_CHUNK_SIZE:
+                    self.size += sink.size
+                    yield sink.pop()
+            zf.comment = self.comment
+        self.size += sink.size
+        yield sink.pop()
+
+
+class MemberCompressor:
+    # chooses the compression of each archive member from its transfer syntax and, with an executor,
+    # compresses up to window_bytes of members ahead of the archive writer; zlib releases the GIL, so
+    # threads deflate in parallel. Without one members are streamed into the archive.
+    def __init__(self, mode='auto', level=DICOM_DEFLATE_LEVEL, executor=None,
+                 window_bytes=DICOM_COMPRESS_WINDOW_MB * 1024 * 1024):
+        if mode not in ('auto', 'deflate', 'store'):
+            raise ValueError('Unknown DICOM compression mode: {}'.format(mode))
+        self.mode = mode
+        self.level = level
+        self.executor = executor if ZIPFILE_PRECOMPRESS else None
+        self.window_bytes = window_bytes if self.executor is not None else 0
+
+    def get_compress_type(self, transfer_syntax):
+        if self.mode == 'store' or (self.mode == 'auto' and is_compressed_transfer_syntax(transfer_syntax)):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def submit(self, filepath, zinfo):
+        if self.executor is None:
+            return None
+        return self.executor.submit(compress_member, filepath, zinfo.compress_type, self.level)
+
+    def write(self, zf, filepath, zinfo, future):
+        if future is None:
+            write_member(zf, filepath, zinfo, self.level)
+        else:
+            write_compressed_member(zf, zinfo, *future.result())
+
+
+def get_transfer_syntax(dcm):
+    file_meta = getattr(getattr(dcm, 'raw', None), 'file_meta', None)
+    return str(file_meta.get('TransferSyntaxUID', '')) if file_meta is not None else ''
+
+
+def is_compressed_transfer_syntax(transfer_syntax):
+    # JPEG, JPEG-LS, JPEG 2000, MPEG, HEVC, HTJ2K (1.2.840.10008.1.2.4.*), RLE and deflated explicit VR
+    return transfer_syntax.startswith('1.2.840.10008.1.2.4.') or transfer_syntax in COMPRESSED_TRANSFER_SYNTAXES
+
+
+def compress_member(filepath, compress_type, level):
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    crc = zlib.crc32(data)
+    size = len(data)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return crc, size, data
+
+
+def write_member(zf, filepath, zinfo, level):
+    # what ZipFile.write does, keeping our ZipInfo (ZipInfo.compress_level is public from python 3.13)
+    if hasattr(zinfo, 'compress_level'):
+        zinfo.compress_level = level
+    else:
+        zinfo._compresslevel = level
+    with open(filepath, 'rb') as src, zf.open(zinfo, 'w') as dst:
+        shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+
+
+def write_compressed_member(zf, zinfo, crc, file_size, data):
+    # zipfile has no public API for adding already compressed data, this mirrors ZipFile._open_to_write
+    # and is only used on the versions in ZIPFILE_PRECOMPRESS
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(data)
+    zinfo.flag_bits = 0x00
+    zip64 = max(file_size, len(data)) > zipfile.ZIP64_LIMIT
+    with zf._lock:
+        if zf._seekable:
+            zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader(zip64))
+        zf.fp.write(data)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+
+
+class ChunkSink:
+    # write-only, unseekable file object buffering the output of a streamed zip
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def get_zip_date_time(timestamp):
+    file_time = max(int(timestamp.strftime('%s')), 315561600)  # zip can't handle < 1980
+    return time.localtime(file_time)[:6]
+
+
+def get_metadata(obj):
+    # subject_*, session_* and acquisition_* attributes with a value, from the instance and its class
+    metadata = {group: {} for group in METADATA_GROUPS}
+    for name in itertools.chain(get_class_metadata_attrs(type(obj)), vars(obj)):
+        field = get_metadata_field(name)
+        if field is not None:
+            value = getattr(obj, name)
+            if value:
+                metadata[field[0]][field[1]] = value
     metadata['session']['subject'] = metadata.pop('subject')
     return metadata
 
 
-def create_archive(content, arcname, metadata=None, outdir=None):
-    outdir = outdir or os.path.dirname(content)
-    files = [(fn, os.path.join(content, fn)) for fn in os.listdir(content)]
-    outpath = os.path.join(outdir, arcname) + '.zip'
-    files.sort(key=lambda f: os.path.getsize(f[1]))
-    with zipfile.ZipFile(outpath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
-        if metadata is not None:
-            zf.comment = json.dumps(metadata, default=metadata_encoder).encode('utf-8')
-        for fn, fp in files:
-            zf.write(fp, os.path.join(arcname, fn))
-    return outpath
+@functools.lru_cache(maxsize=None)
+def get_metadata_field(name):
+    group, _, key = name.partition('_')
+    return (group, key) if group in METADATA_GROUPS and key else None
+
+
+@functools.lru_cache(maxsize=None)
+def get_class_metadata_attrs(cls):
+    # properties and other class attributes, computed once per class
+    return tuple(name for name in dir(cls) if get_metadata_field(name) is not None)
+
+
+def set_upload_containers(metadata, fw_project, master_subject_code, subject, subject_fields):
+    # points the metadata at the destination project and master code subject, the subject fields
+    # only fill what the existing subject is missing
+    metadata.setdefault('group', {})['_id'] = fw_project['group']
+    metadata.setdefault('project', {})['label'] = fw_project['label']
+    subject_info = metadata['session']['subject']
+    metadata['session']['subject'] = {'master_code': master_subject_code}
+    for key in subject_fields:
+        if not (subject and subject.get(key)) and subject_info.get(key):
+            metadata['session']['subject'][key] = subject_info[key]
+    return metadata
+
+
+class LazyPformat:
+    # pretty prints debug log arguments only if the record is emitted, callables are called then
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pprint.pformat(self.obj() if callable(self.obj) else self.obj)
 
 
 def metadata_encoder(obj):
+    # datetimes are the common case, naive ones are UTC
     if isinstance(obj, datetime.datetime):
         if obj.tzinfo is None:
-            obj = pytz.timezone('UTC').localize(obj)
+            obj = obj.replace(tzinfo=pytz.utc)
         return obj.isoformat()
     elif isinstance(obj, datetime.tzinfo):
         return obj.zone
@@ -345,12 +1683,687 @@ class FwApi(requests.Session):
         super().__init__(*args, **kwargs)
         self.base_url = base_url.rstrip('/') + '/'
         self.headers.update({'Authorization': 'scitran-user ' + api_key})
+        TRANSPORT.mount(self)
 
     def request(self, method, url, *args, **kwargs):
         url = urljoin(self.base_url, url)
         return super().request(method, url, *args, **kwargs)
 
 
+class ConcurrencyLimiter:
+    # AIMD limit of concurrent requests: halved when a server throttles (at most once per backoff
+    # period), grown by about one for every limit-worth of healthy responses. Nested slots taken
+    # by the same thread share the outer one.
+    def __init__(self, max_limit=HTTP_MAX_CONCURRENCY):
+        self.max_limit = max(1, max_limit)
+        self.limit = float(self.max_limit)
+        self.active = 0
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+        self.local = threading.local()
+
+    @property
+    def depth(self):
+        return getattr(self.local, 'depth', 0)
+
+    @contextlib.contextmanager
+    def slot(self):
+        depth = self.depth
+        if not depth:
+            with self.cond:
+                while self.active >= int(self.limit):
+                    self.cond.wait()
+                self.active += 1
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            if not depth:
+                with self.cond:
+                    self.active -= 1
+                    self.cond.notify()
+
+    def feedback(self, throttled):
+        with self.cond:
+            if throttled:
+                now = time.monotonic()
+                if now - self.last_decrease >= RETRY_BACKOFF * 2:
+                    self.last_decrease = now
+                    self.limit = max(1.0, self.limit / 2)
+                    log.warning('  Server is throttling, lowering request concurrency to %s', int(self.limit))
+            elif self.limit < self.max_limit:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+                self.cond.notify_all()
+
+
+class RetryAdapter(requests.adapters.HTTPAdapter):
+    # keep-alive connection pool whose requests are concurrency limited, transient failures of
+    # requests with a replayable body are retried unless the caller retries already (retry_call)
+    def __init__(self, limiter, retries=RETRY_ATTEMPTS, **kwargs):
+        self.limiter = limiter
+        self.retries = retries
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        attempts = self.retries if self.limiter.depth == 0 and isinstance(request.body, (type(None), bytes, str)) else 1
+        for attempt in range(attempts):
+            with self.limiter.slot():
+                try:
+                    resp = super().send(request, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as exc:
+                    if attempt == attempts - 1:
+                        raise
+                    resp, error = None, exc
+            if resp is not None:
+                self.limiter.feedback(throttled=resp.status_code in THROTTLE_STATUS_CODES)
+                if attempt == attempts - 1 or resp.status_code not in TRANSIENT_STATUS_CODES:
+                    return resp
+                error = '{} {} returned {}'.format(request.method, request.url, resp.status_code)
+                resp.close()
+            delay = get_retry_delay(attempt, resp.headers.get('Retry-After') if resp is not None else None)
+            log.warning('  %s, retrying in %.1fs', error, delay)
+            time.sleep(delay)
+
+
+class Transport:
+    # connection pooling, retry and concurrency settings shared by every HTTP session of the run
+    def __init__(self):
+        self.pool_size = HTTP_POOL_SIZE
+        self.retries = RETRY_ATTEMPTS
+        self.limiter = ConcurrencyLimiter(HTTP_MAX_CONCURRENCY)
+
+    def configure(self, pool_size=HTTP_POOL_SIZE, max_concurrency=HTTP_MAX_CONCURRENCY, retries=RETRY_ATTEMPTS):
+        self.pool_size = pool_size
+        self.retries = max(1, retries)
+        self.limiter = ConcurrencyLimiter(max_concurrency)
+
+    def mount(self, session):
+        adapter = RetryAdapter(self.limiter, retries=self.retries, pool_connections=self.pool_size,
+                               pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+
+TRANSPORT = Transport()
+
+
+class StageMetrics:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(METRICS_BUCKETS)
+        self.overflow = 0
+        self.first_start = None
+        self.last_end = None
+
+    def add(self, seconds, nbytes, count, error, end):
+        self.count += count
+        self.errors += int(error)
+        self.bytes += nbytes
+        self.seconds += seconds
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.overflow += 1
+        start = end - seconds
+        self.first_start = start if self.first_start is None else min(self.first_start, start)
+        self.last_end = end if self.last_end is None else max(self.last_end, end)
+
+    def as_dict(self):
+        # stages run concurrently, throughput is measured over the wall time the stage was active
+        wall = (self.last_end - self.first_start) if self.count else 0
+        samples = sum(self.buckets) + self.overflow
+        return collections.OrderedDict([
+            ('count', self.count),
+            ('errors', self.errors),
+            ('bytes', self.bytes),
+            ('seconds', round(self.seconds, 6)),
+            ('mean_seconds', round(self.seconds / samples, 6) if samples else 0),
+            ('wall_seconds', round(wall, 6)),
+            ('items_per_second', round(self.count / wall, 3) if wall else 0),
+            ('bytes_per_second', round(self.bytes / wall, 3) if wall else 0),
+            ('latency_buckets', collections.OrderedDict(
+                (str(bound), n) for bound, n in zip(METRICS_BUCKETS, itertools.accumulate(self.buckets)))),
+        ])
+
+
+class Metrics:
+    # counts, bytes and latency histograms of the hot paths per stage and modality, written as
+    # gear outputs at the end of the run
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, stage, modality, nbytes=0, count=1):
+        sample = types.SimpleNamespace(bytes=nbytes, count=count)
+        start = time.perf_counter()
+        error = False
+        try:
+            yield sample
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record(stage, modality, time.perf_counter() - start, nbytes=sample.bytes,
+                        count=sample.count if not error else 0, error=error)
+
+    def record(self, stage, modality, seconds, nbytes=0, count=1, error=False):
+        with self.lock:
+            stats = self.stages.setdefault((stage, modality), StageMetrics())
+            stats.add(seconds, nbytes, count, error, time.perf_counter())
+
+    def as_dict(self):
+        with self.lock:
+            return collections.OrderedDict(
+                ('{}/{}'.format(stage, modality), stats.as_dict()) for (stage, modality), stats in self.stages.items())
+
+    def log_summary(self):
+        if not self.stages:
+            return
+        lines = ['{:<20} {:>8} {:>6} {:>10} {:>10} {:>9} {:>9}'.format(
+            'stage', 'count', 'errors', 'MB', 'mean ms', 'items/s', 'MB/s')]
+        for name, stats in self.as_dict().items():
+            lines.append('{:<20} {:>8} {:>6} {:>10.1f} {:>10.1f} {:>9.1f} {:>9.2f}'.format(
+                name, stats['count'], stats['errors'], stats['bytes'] / 1e6, stats['mean_seconds'] * 1e3,
+                stats['items_per_second'], stats['bytes_per_second'] / 1e6))
+        log.info('Stage metrics:\n%s', '\n'.join(lines))
+
+    def write(self, output_dir):
+        metrics = self.as_dict()
+        with open(os.path.join(output_dir, METRICS_JSON_FILENAME), 'w') as f:
+            json.dump(metrics, f, indent=2)
+        with open(os.path.join(output_dir, METRICS_PROM_FILENAME), 'w') as f:
+            f.write(self.format_prometheus())
+
+    def format_prometheus(self):
+        lines = []
+        for metric, metric_type in (('ghc_import_stage_seconds', 'histogram'),
+                                    ('ghc_import_stage_items_total', 'counter'),
+                                    ('ghc_import_stage_errors_total', 'counter'),
+                                    ('ghc_import_stage_bytes_total', 'counter')):
+            lines.append('# TYPE {} {}'.format(metric, metric_type))
+            with self.lock:
+                stages = list(self.stages.items())
+            for (stage, modality), stats in stages:
+                labels = 'stage="{}",modality="{}"'.format(stage, modality)
+                if metric_type == 'histogram':
+                    for bound, n in zip(METRICS_BUCKETS, itertools.accumulate(stats.buckets)):
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, bound, n))
+                    samples = sum(stats.buckets) + stats.overflow
+                    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(metric, labels, samples))
+                    lines.append('{}_sum{{{}}} {}'.format(metric, labels, stats.seconds))
+                    lines.append('{}_count{{{}}} {}'.format(metric, labels, samples))
+                else:
+                    value = {'ghc_import_stage_items_total': stats.count,
+                             'ghc_import_stage_errors_total': stats.errors,
+                             'ghc_import_stage_bytes_total': stats.bytes}[metric]
+                    lines.append('{}{{{}}} {}'.format(metric, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class Pipeline:
+    # runs items through stages of worker threads connected by bounded queues
+    def __init__(self, stages, max_in_flight=1, finalize=None):
+        self.stages = [(name, func, max(1, workers)) for name, func, workers in stages]
+        self.queues = [queue.Queue(maxsize=workers) for _, _, workers in self.stages]
+        self.in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+        self.finalize = finalize
+        self.error = None
+        self.abort = threading.Event()
+
+    def run(self, items):
+        stage_threads = []
+        for index, (name, _, workers) in enumerate(self.stages):
+            threads = [threading.Thread(target=self.work, args=(index,), name='{}-{}'.format(name, i), daemon=True)
+                       for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            stage_threads.append(threads)
+
+        try:
+            for item in items:
+                while not self.in_flight.acquire(timeout=0.1):
+                    if self.abort.is_set():
+                        break
+                if self.abort.is_set():
+                    break
+                self.queues[0].put(item)
+        except Exception as exc:
+            self.fail(exc)
+
+        # shut down stage by stage, each stage drains its queue before the next one is told to stop
+        for index, threads in enumerate(stage_threads):
+            for _ in threads:
+                self.queues[index].put(None)
+            for thread in threads:
+                thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def work(self, index):
+        name, func, _ = self.stages[index]
+        while True:
+            item = self.queues[index].get()
+            if item is None:
+                return
+            done = True
+            if not self.abort.is_set():
+                try:
+                    func(item)
+                    done = index == len(self.stages) - 1
+                except Exception as exc:
+                    log.error('  %s stage failed: %s', name, exc)
+                    self.fail(exc)
+            if done or self.abort.is_set():
+                self.done(item)
+            else:
+                self.queues[index + 1].put(item)
+
+    def done(self, item):
+        # a failing finalize must not end the worker, upstream stages would block on its full queue
+        try:
+            if self.finalize is not None:
+                self.finalize(item)
+        except Exception as exc:
+            log.error('  Finalizing failed: %s', exc)
+            self.fail(exc)
+        finally:
+            self.in_flight.release()
+
+    def fail(self, exc):
+        if self.error is None:
+            self.error = exc
+        self.abort.set()
+
+
+class MasterCodeResolver:
+    # memoizes subjects/master-code responses by canonicalized payload, one round trip per patient and run
+    def __init__(self, fw_api, workers=MASTER_CODE_WORKERS):
+        self.fw_api = fw_api
+        self.workers = workers
+        self.codes = {}
+        # lookups are counted by get only: the first get of a patient is a miss, also when a prefetch
+        # already resolved it (counted as prefetched), later ones are hits
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.unclaimed = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(payload):
+        return tuple(sorted((k, v.strip() if isinstance(v, str) else v) for k, v in payload.items()))
+
+    def get(self, payload, modality):
+        key = self.get_key(payload)
+        with self.lock:
+            if key in self.unclaimed:
+                self.unclaimed.discard(key)
+                self.misses += 1
+                self.prefetched += 1
+            elif key in self.codes:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return self.resolve(key, payload, modality)
+
+    def resolve(self, key, payload, modality):
+        with self.lock:
+            future = self.codes.get(key)
+            resolve = future is None
+            if resolve:
+                future = self.codes[key] = concurrent.futures.Future()
+
+        if resolve:
+            try:
+                with METRICS.timer('master_code', modality):
+                    code = get_master_subject_code(payload, self.fw_api)
+                future.set_result(code)
+            except Exception as exc:
+                with self.lock:
+                    del self.codes[key]
+                future.set_exception(exc)
+        return future.result()
+
+    def prefetch(self, payloads, modality):
+        pending = {}
+        with self.lock:
+            for payload in payloads:
+                key = self.get_key(payload)
+                if key not in self.codes:
+                    pending.setdefault(key, payload)
+            self.unclaimed.update(pending)
+        if not pending:
+            return
+        log.debug('  Resolving %s master subject codes...', len(pending))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for _ in executor.map(lambda item: self.resolve(item[0], item[1], modality), pending.items()):
+                pass
+
+    def log_stats(self):
+        log.info('  Master subject codes: %s hits, %s misses (%s of them prefetched)', self.hits, self.misses,
+                 self.prefetched)
+
+
+class SubjectIndex:
+    # subjects of the destination project keyed by master code, loaded once per run
+    def __init__(self, fw_api, fw_project):
+        self.fw_api = fw_api
+        self.fw_project = fw_project
+        self.subjects = None
+        self.lock = threading.Lock()
+
+    def load(self, modality):
+        with METRICS.timer('subject_load', modality):
+            resp = self.fw_api.get('projects/{}/subjects'.format(self.fw_project['_id']))
+        resp.raise_for_status()
+        self.subjects = {}
+        for subject in resp.json():
+            if subject.get('master_code'):
+                self.subjects.setdefault(subject['master_code'], []).append(subject)
+        log.debug('  Loaded %s subjects of project %s', len(self.subjects), self.fw_project['label'])
+
+    def get(self, code, modality):
+        # the first lookup includes loading the index
+        with METRICS.timer('subject_lookup', modality), self.lock:
+            if self.subjects is None:
+                self.load(modality)
+            matching_subjects = self.subjects.get(code, [])
+
+        if len(matching_subjects) > 1:
+            raise Exception("Too many matching study, can't decide what to do")
+        elif len(matching_subjects) == 1:
+            return matching_subjects[0]
+
+        return None
+
+    def update(self, code, subject):
+        # merge the subject fields of a successful upload, creating the entry if needed
+        with self.lock:
+            if self.subjects is None:
+                return
+            matching_subjects = self.subjects.setdefault(code, [{'master_code': code, 'project': self.fw_project['_id']}])
+            if len(matching_subjects) == 1:
+                matching_subjects[0].update({k: v for k, v in subject.items() if v})
+
+
+def is_imported(journal, imported, kind, key, series_uid=None, filename=None, shard=None):
+    # the shard counts journal hits of units whose ownership wasn't checked yet
+    if journal.is_done(kind, key):
+        log.info('  %s %s is in the import journal, SKIPPING', kind.upper(), key)
+        if shard is not None:
+            shard.resume(kind)
+        return True
+    if imported is not None and (imported.has_series(series_uid) or imported.has_file(filename)):
+        log.info('  %s %s already exists in the project, SKIPPING', kind.upper(), key)
+        journal.record(kind, key)
+        return True
+    return False
+
+
+class Shard:
+    # deterministic partition of the work by patient ID, so that every object of a patient (and the
+    # subject created for it) is handled by one of the gear jobs sharing an import
+    def __init__(self, index=0, count=1):
+        if not 0 <= index < count:
+            raise Exception('Invalid shard {} of {}'.format(index, count))
+        self.index = index
+        self.count = count
+        self.counts = collections.OrderedDict()
+        self.completed = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_shard(patient_id, count):
+        # a stable hash, python's hash() is salted per process
+        digest = hashlib.sha1((patient_id or '').strip().encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % count
+
+    def owns(self, kind, key, patient_id):
+        owned = self.count == 1 or self.get_shard(patient_id, self.count) == self.index
+        self.count_unit(kind, 'owned' if owned else 'other_shards')
+        if not owned:
+            log.debug('  %s %s belongs to another shard, SKIPPING', kind.upper(), key)
+        return owned
+
+    def resume(self, kind):
+        # units of the resumed journal skipped before their patient, and so their shard, was known
+        self.count_unit(kind, 'resumed')
+
+    def count_unit(self, kind, status):
+        with self.lock:
+            counts = self.counts.setdefault(
+                kind, collections.OrderedDict([('owned', 0), ('other_shards', 0), ('resumed', 0)]))
+            counts[status] += 1
+
+    def write(self, output_dir):
+        if self.count == 1:
+            return
+        # every shard sees the whole input, coverage is complete when all the shard reports are completed
+        # and their owned + resumed counts add up to the owned + other_shards + resumed count of any one
+        report = collections.OrderedDict([('shard_index', self.index), ('shard_count', self.count),
+                                          ('completed', self.completed), ('units', self.counts)])
+        with open(os.path.join(output_dir, SHARD_REPORT_FILENAME.format(self.index)), 'w') as f:
+            json.dump(report, f, indent=2)
+        log.info('Shard %s of %s: %s', self.index, self.count, json.dumps(self.counts))
+
+
+class SyncState:
+    # high-water marks of the synced stores in the project info, every shard of an import has its own.
+    # A watermark is only moved after everything changed since the previous one was imported.
+    def __init__(self, fw_api, fw_project, shard=None):
+        self.fw_api = fw_api
+        self.fw_project = fw_project
+        self.key = SYNC_INFO_KEY
+        if shard is not None and shard.count > 1:
+            self.key += '_shard_{}_of_{}'.format(shard.index, shard.count)
+        self.state = copy.deepcopy(fw_project.get('info', {}).get(self.key, {}))
+        started = datetime.datetime.utcnow() - SYNC_OVERLAP
+        self.started = started.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def get_watermark(self, key, store):
+        # changing the store starts over
+        state = self.state.get(key, {})
+        return state.get('watermark') if state.get('store') == store else None
+
+    def advance(self, key, store, failed=0):
+        if not store:
+            return
+        if failed:
+            log.warning('%s %s failed to import, the %s watermark is kept for the next sync to retry them',
+                        failed, key, key)
+            return
+        self.state[key] = {'store': store, 'watermark': self.started}
+        resp = self.fw_api.post('projects/{}/info'.format(self.fw_project['_id']), json={'set': {self.key: self.state}})
+        resp.raise_for_status()
+        log.info('Sync watermark of %s set to %s', key, self.started)
+
+
+def search_dicom_changes(hc_api, hc_dicomstore, since):
+    # QIDO has no insertion time, studies are selected by StudyDate from the day of the watermark. Studies
+    # stored later with an older StudyDate, or none, aren't found
+    dicomweb = get_dicomweb(hc_api, hc_dicomstore)
+    search_filters = {'StudyDate': since[:10].replace('-', '') + '-'} if since else {}
+    offset = 0
+    while True:
+        with METRICS.timer('search', 'dicom'):
+            page = retry_call(dicomweb.search_for_studies, search_filters=search_filters,
+                              fields=['StudyInstanceUID'], limit=SYNC_PAGE_SIZE, offset=offset)
+        for study in page:
+            yield study[SERIES_SEARCH_TAGS['StudyInstanceUID']]['Value'][0]
+        offset += len(page)
+        if len(page) < SYNC_PAGE_SIZE:
+            return
+
+
+def list_hl7_changes(hc_api, hc_hl7store, since):
+    kwargs = {'parent': hc_hl7store, 'pageSize': SYNC_PAGE_SIZE}
+    if since:
+        kwargs['filter'] = 'sendTime >= "{}"'.format(since)
+    while True:
+        resp = retry_call(hc_api.hl7V2Stores.messages.list, **kwargs)
+        for msg in resp.get('hl7V2Messages', []):
+            yield msg['name'].rsplit('/', 1)[-1]
+        if not resp.get('nextPageToken'):
+            return
+        kwargs['pageToken'] = resp['nextPageToken']
+
+
+def search_fhir_changes(hc_api, hc_fhirstore, resource_types, since):
+    # one search per resource type, the pages of all types are requested together in batch Bundles
+    queries = ['{}?_elements=id&_count={}'.format(resource_type, SYNC_PAGE_SIZE) for resource_type in resource_types]
+    if since:
+        queries = [query + '&_lastUpdated=ge' + since for query in queries]
+    while queries:
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'batch',
+            'entry': [{'request': {'method': 'GET', 'url': query}} for query in queries]
+        }
+        resp = retry_call(hc_api.fhirStores.fhir.executeBundle, parent=hc_fhirstore, body=bundle)
+        next_queries = []
+        for query, entry in zip(queries, resp.get('entry', [])):
+            status = entry.get('response', {}).get('status', '')
+            if not status.startswith('200'):
+                # a missing page would be skipped for good once the watermark moves
+                raise Exception('FHIR search {} failed with status {}'.format(query, status))
+            for result in entry['resource'].get('entry', []):
+                yield '{}/{}'.format(result['resource']['resourceType'], result['resource']['id'])
+            for link in entry['resource'].get('link', []):
+                if link['relation'] == 'next':
+                    next_queries.append(link['url'].split('/fhir/', 1)[-1])
+        queries = next_queries
+
+
+class ImportJournal:
+    # JSON lines of imported units (DICOM series UID, HL7 message ID, FHIR reference), each line is
+    # flushed to disk as soon as the unit is uploaded so a rerun can resume where a failed run stopped
+    def __init__(self, path=None, resume_path=None):
+        self.path = path
+        self.done = set()
+        self.failed = collections.defaultdict(set)
+        self.skipped = collections.defaultdict(set)
+        self.lock = threading.Lock()
+        self.file = None
+        for journal_path in (resume_path, path):
+            if journal_path and os.path.exists(journal_path):
+                self.load(journal_path)
+        if self.done:
+            log.info('Resuming import, %s units already imported', len(self.done))
+        if path:
+            # rewrite the resumed entries first so the journal is complete on its own (and any
+            # partial line of a killed run is dropped), then keep appending to it
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for kind, key in sorted(self.done):
+                    f.write(self.format_entry(kind, key, 'skipped' if key in self.skipped[kind] else None))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self.file = open(path, 'a')
+
+    def load(self, path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.done.add((entry['type'], entry['id']))
+                if entry.get('status') == 'skipped':
+                    self.skipped[entry['type']].add(entry['id'])
+
+    @staticmethod
+    def format_entry(kind, key, status=None):
+        entry = {'type': kind, 'id': key}
+        if status:
+            entry['status'] = status
+        return json.dumps(entry) + '\n'
+
+    def is_done(self, kind, key):
+        with self.lock:
+            return (kind, key) in self.done
+
+    def record(self, kind, key, status=None):
+        with self.lock:
+            self.done.add((kind, key))
+            if status == 'skipped':
+                self.skipped[kind].add(key)
+            if self.file is not None:
+                self.file.write(self.format_entry(kind, key, status))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def fail(self, kind, key):
+        # transient failures aren't written, a resumed run or the next sync tries them again
+        with self.lock:
+            self.failed[kind].add(key)
+
+    def skip(self, kind, key):
+        # units that fail the same way on every run (no patient, deleted) are journaled as skipped, so
+        # that they neither hold the sync watermark back nor get read again on resume
+        self.record(kind, key, status='skipped')
+
+    def get_failed(self, kind):
+        with self.lock:
+            return len(self.failed[kind])
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class ImportedIndex:
+    # acquisition UIDs and file names already in the destination project, loaded once per run
+    def __init__(self, fw_api, fw_project):
+        self.fw_api = fw_api
+        self.fw_project = fw_project
+        self.series_uids = None
+        self.filenames = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        resp = self.fw_api.get('acquisitions', params={'filter': 'parents.project=' + self.fw_project['_id']})
+        resp.raise_for_status()
+        present = collections.defaultdict(set)
+        expected = collections.defaultdict(set)
+        self.filenames = set()
+        for acquisition in resp.json():
+            if acquisition.get('uid'):
+                # DICOM acquisition UIDs are the series UID, suffixed with _<acq_no> for multi acquisition series
+                series_uid = acquisition['uid'].split('_')[0]
+                present[series_uid].add(acquisition['uid'])
+                expected[series_uid].update(
+                    acquisition.get('info', {}).get(SERIES_ACQUISITIONS_INFO_KEY, [acquisition['uid']]))
+            self.filenames.update(f['name'] for f in acquisition.get('files', []))
+        self.series_uids = {series_uid for series_uid, uids in present.items() if expected[series_uid] <= uids}
+        log.debug('  Loaded %s acquisitions of project %s', len(self.series_uids), self.fw_project['label'])
+
+    def has_series(self, series_uid):
+        return series_uid is not None and series_uid in self.get_index()[0]
+
+    def has_file(self, filename):
+        return filename is not None and filename in self.get_index()[1]
+
+    def get_index(self):
+        with self.lock:
+            if self.series_uids is None:
+                self.load()
+            return self.series_uids, self.filenames
+
+
 class HL7Message:
     def __init__(self, hc_api_msg):
         self.msg_json = hc_api_msg
@@ -386,7 +2399,7 @@ class HL7Message:
 
 
 class FHIRResource:
-    def __init__(self, resource, hc_api, hc_fhirstore):
+    def __init__(self, resource, hc_api, hc_fhirstore, patients=None):
         self.raw = resource
         self.type = self.raw['resourceType']
         self.last_updated = dateutil.parser.parse(self.raw['meta']['lastUpdated'])
@@ -395,12 +2408,7 @@ class FHIRResource:
         if self.type == 'Patient':
             patient = self
         else:
-            subject_ref = None
-            if self.raw.get('patient', {}).get('reference'):
-                subject_ref = self.raw.get('patient', {}).get('reference')
-
-            if self.raw.get('subject', {}).get('reference'):
-                subject_ref = self.raw.get('subject', {}).get('reference')
+            subject_ref = get_fhir_subject_ref(self.raw)
 
             if not subject_ref:
                 log.warning('       No subject found, SKIPPING')
@@ -408,11 +2416,7 @@ class FHIRResource:
                 log.warning('       Subject type %s is not supported yet, SKIPPING', subject_ref.split('/')[0])
             else:
                 patient_id = subject_ref.split('/')[1]
-                patient = FHIRResource(
-                    hc_api.fhirStores.fhir.read(name='{}/fhir/{}/{}'.format(hc_fhirstore, 'Patient', patient_id)),
-                    hc_api,
-                    hc_fhirstore
-                )
+                patient = (patients or FHIRPatientCache(hc_api, hc_fhirstore)).get(patient_id)
 
         self.patient_id = patient.get_id() if patient else None
         self.subject_code = 'ex' + self.patient_id if self.patient_id else None
@@ -472,15 +2476,208 @@ class FHIRResource:
         return first_name, last_name
 
     def _get_loinc_number_details(self, loinc_number):
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        with open(os.path.join(dir_path, 'LoincTableCore.csv'), newline='') as csvfile:
+        loinc_index = get_loinc_index()
+        if loinc_index is None:
+            return None
+        return loinc_index.lookup(loinc_number)
+
+
+def get_fhir_subject_ref(resource):
+    subject_ref = None
+    if resource.get('patient', {}).get('reference'):
+        subject_ref = resource.get('patient', {}).get('reference')
+
+    if resource.get('subject', {}).get('reference'):
+        subject_ref = resource.get('subject', {}).get('reference')
+
+    return subject_ref
+
+
+def get_fhir_patient_id(resource):
+    if resource['resourceType'] == 'Patient':
+        return None
+    subject_ref = get_fhir_subject_ref(resource)
+    if subject_ref and subject_ref.startswith('Patient/'):
+        return subject_ref.split('/')[1]
+    return None
+
+
+def fhir_read(hc_api, hc_fhirstore, ref):
+    return retry_call(hc_api.fhirStores.fhir.read, name='{}/fhir/{}'.format(hc_fhirstore, ref))
+
+
+def read_fhir_resources(hc_api, hc_fhirstore, refs, errors=None):
+    # reads the references grouped by resource type, returns (ref, resource) pairs in input order. The
+    # refs that couldn't be read are left out, and set in errors to whether the failure was transient
+    refs_by_type = collections.OrderedDict()
+    for ref in refs:
+        log.info('  Fetching FHIR resource %s', ref)
+        refs_by_type.setdefault(ref.split('/')[0], []).append(ref)
+    resources = {}
+    for type_refs in refs_by_type.values():
+        with METRICS.timer('fetch', 'fhir', count=len(type_refs)):
+            resources.update(fhir_read_many(hc_api, hc_fhirstore, type_refs, errors=errors))
+    return [(ref, resources[ref]) for ref in refs if ref in resources]
+
+
+def fhir_read_many(hc_api, hc_fhirstore, refs, errors=None):
+    # reads many resources with one batch Bundle; entries failing with a transient error are retried
+    # one by one, other failed entries are logged and left out of the result (and set in errors)
+    errors = errors if errors is not None else {}
+    bundle = {
+        'resourceType': 'Bundle',
+        'type': 'batch',
+        'entry': [{'request': {'method': 'GET', 'url': ref}} for ref in refs]
+    }
+    try:
+        resp = retry_call(hc_api.fhirStores.fhir.executeBundle, parent=hc_fhirstore, body=bundle)
+    except Exception as exc:
+        log.warning('  FHIR batch read failed, falling back to single reads: %s', exc)
+        resources = {ref: try_fhir_read(hc_api, hc_fhirstore, ref, errors) for ref in refs}
+        return {ref: resource for ref, resource in resources.items() if resource is not None}
+
+    entries = resp.get('entry', [])
+    if len(entries) != len(refs):
+        log.error('  FHIR batch read returned %s entries for %s resources', len(entries), len(refs))
+        entries = entries[:len(refs)] + [{}] * (len(refs) - len(entries))
+    resources = {}
+    for ref, entry in zip(refs, entries):
+        status = entry.get('response', {}).get('status', '')
+        if status.startswith('200') and entry.get('resource'):
+            resources[ref] = entry['resource']
+        elif status.split(' ')[0].isdigit() and int(status.split(' ')[0]) in TRANSIENT_STATUS_CODES:
+            resource = try_fhir_read(hc_api, hc_fhirstore, ref, errors)
+            if resource is not None:
+                resources[ref] = resource
+        else:
+            log.error('  Could not read FHIR resource %s (%s), SKIPPING', ref, status or 'no response entry')
+            # a missing entry says nothing about the resource itself
+            errors[ref] = not status
+    return resources
+
+
+def try_fhir_read(hc_api, hc_fhirstore, ref, errors=None):
+    try:
+        return fhir_read(hc_api, hc_fhirstore, ref)
+    except Exception as exc:
+        log.error('  Could not read FHIR resource %s (%s), SKIPPING', ref, exc)
+        if errors is not None:
+            errors[ref] = is_transient_error(exc) or get_error_status(exc) is None
+        return None
+
+
+class FHIRPatientCache:
+    # per-run cache of Patient resources, each patient is read at most once. Patients that can't be
+    # read are cached as None, their resources have no patient and are skipped
+    def __init__(self, hc_api, hc_fhirstore):
+        self.hc_api = hc_api
+        self.hc_fhirstore = hc_fhirstore
+        self.patients = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def add(self, resource):
+        patient = FHIRResource(resource, self.hc_api, self.hc_fhirstore, patients=self)
+        future = concurrent.futures.Future()
+        future.set_result(patient)
+        with self.lock:
+            self.patients.setdefault(resource['id'], future)
+
+    def get(self, patient_id):
+        with self.lock:
+            future = self.patients.get(patient_id)
+            read = future is None
+            if read:
+                future = self.patients[patient_id] = concurrent.futures.Future()
+
+        if read:
+            resource = try_fhir_read(self.hc_api, self.hc_fhirstore, 'Patient/' + patient_id, self.errors)
+            future.set_result(FHIRResource(resource, self.hc_api, self.hc_fhirstore, patients=self)
+                              if resource is not None else None)
+        return future.result()
+
+    def failed_transiently(self, patient_id):
+        return self.errors.get('Patient/' + patient_id, False)
+
+    def prefetch(self, patient_ids):
+        with self.lock:
+            missing = sorted({patient_id for patient_id in patient_ids
+                              if patient_id and patient_id not in self.patients})
+        if not missing:
+            return
+        log.debug('  Reading %s FHIR patients...', len(missing))
+        resources = fhir_read_many(self.hc_api, self.hc_fhirstore, ['Patient/' + patient_id for patient_id in missing],
+                                   errors=self.errors)
+        for resource in resources.values():
+            self.add(resource)
+        for patient_id in missing:
+            if 'Patient/' + patient_id not in resources:
+                # logged by fhir_read_many
+                future = concurrent.futures.Future()
+                future.set_result(None)
+                with self.lock:
+                    self.patients.setdefault(patient_id, future)
+
+
+class LoincIndex:
+    def __init__(self, index_path, cache_size=LOINC_CACHE_SIZE):
+        self.conn = sqlite3.connect('file:{}?mode=ro'.format(index_path), uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _lookup(self, loinc_number):
+        with self.lock:
+            row = self.conn.execute('SELECT row FROM loinc WHERE loinc_num = ?', (loinc_number,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def build(table_path, index_path):
+        tmp_path = index_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with open(table_path, newline='') as csvfile:
             dialect = csv.Sniffer().sniff(csvfile.read(1024))
             csvfile.seek(0)
             reader = csv.DictReader(csvfile, dialect=dialect)
-            for row in reader:
-                if row['LOINC_NUM'] == loinc_number:
-                    return row
-            return None
+            conn = sqlite3.connect(tmp_path)
+            try:
+                conn.execute('CREATE TABLE loinc (loinc_num TEXT PRIMARY KEY, row TEXT NOT NULL)')
+                conn.executemany('INSERT OR IGNORE INTO loinc VALUES (?, ?)',
+                                 ((row['LOINC_NUM'], json.dumps(row)) for row in reader))
+                conn.commit()
+            finally:
+                conn.close()
+        os.replace(tmp_path, index_path)  # atomic, concurrent readers never see a partial index
+
+
+_loinc_index = None
+_loinc_index_lock = threading.Lock()
+
+
+def build_loinc_index(table_path=LOINC_TABLE_PATH, index_path=LOINC_INDEX_PATH):
+    if not os.path.exists(table_path):
+        log.warning('LOINC table %s not found, skipping index build', table_path)
+        return None
+    # fall back to the temp dir when the gear directory is read-only
+    for path in (index_path, os.path.join(tempfile.gettempdir(), os.path.basename(index_path))):
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(table_path):
+            return path
+        try:
+            log.info('Building LOINC index %s', path)
+            LoincIndex.build(table_path, path)
+            return path
+        except (OSError, sqlite3.Error):
+            log.warning('Could not write LOINC index %s', path)
+    return None
+
+
+def get_loinc_index():
+    global _loinc_index
+    with _loinc_index_lock:
+        if _loinc_index is None:
+            index_path = build_loinc_index()
+            _loinc_index = LoincIndex(index_path) if index_path else False
+    return _loinc_index or None
 
 
 if __name__ == '__main__':
@@ -1,9 +1,19 @@
 import base64
+import collections
+import concurrent.futures
 import datetime
+import hashlib
 import json
 import mock
+import os
+import pydicom
 import pytest
+import requests
+import tempfile
+import zipfile
+import io
 from io import StringIO
+from dicomweb_client.api import DICOMwebClient
 
 import run
 
@@ -87,36 +97,40 @@ CONFIG = {
 @mock.patch('run.MultipartEncoder')
 @mock.patch('run.pkg_series')
 @mock.patch('run.search_uids')
-@mock.patch('run.get_subject_by_master_code')
+@mock.patch('run.SubjectIndex')
 @mock.patch('run.get_master_subject_code')
-def test_dicom_import(mock_get_master_subject_code, mock_get_subject_by_master_code,
-                      mock_search_uids, mock_pkg_series, mock_mpe, mock_json):
+def test_dicom_import(mock_get_master_subject_code, MockSubjectIndex,
+                      mock_search_uids, mock_pkg_series, mock_mpe, mock_json, tmp_path):
     mock_get_master_subject_code.return_value = 'H3B125'
-    mock_get_subject_by_master_code.return_value = None
+    MockSubjectIndex.return_value.get.return_value = None
     mock_dicomweb = mock.Mock()
     mock_dicomweb.retrieve_series.return_value = []
     mock_search_uids.return_value = [('1.2.840.113619.2.243.4814948993375131.82665.1495.9395539',
-                                      '1.3.46.670589.11.0.0.11.4.2.0.12098.5.7610.1693289264174240079')]
-    mock_pkg_series.return_value = METADATA_MAP
+                                      '1.3.46.670589.11.0.0.11.4.2.0.12098.5.7610.1693289264174240079', 'MRN')]
+    arc_path, metadata = list(METADATA_MAP.items())[0]
+    arc_path = str(tmp_path / os.path.basename(arc_path))
+    open(arc_path, 'wb').close()
+    mock_pkg_series.return_value = [run.DicomArchive(os.path.basename(arc_path)[:-len('.zip')], arc_path, metadata)]
     mock_hc_api = mock.Mock()
     mock_hc_api.dicomStores.dicomWeb.return_value = mock_dicomweb
     mock_api = mock.Mock()
     mock_api.post.return_value = mock.Mock()
 
     with mock.patch('builtins.open', mock.mock_open(read_data=''), create=True) as mock_builtin_open:
-        run.import_dicom_files(mock_hc_api, 'hc_dicomstore', IMPORT_IDS['dicoms'], mock_api, PROJECT)
+        run.import_dicom_files(mock_hc_api, 'hc_dicomstore', IMPORT_IDS['dicoms'], mock_api, PROJECT,
+                               config={'dicom_stream_retrieve': False, 'dicom_upload_mode': 'file'})
     mock_json.dumps.assert_called_once_with(list(METADATA_MAP.values())[0], default=run.metadata_encoder)
     mock_api.post.assert_called_once()
 
 @mock.patch('run.MultipartEncoder')
-@mock.patch('run.get_subject_by_master_code')
+@mock.patch('run.SubjectIndex')
 @mock.patch('run.get_master_subject_code')
-def test_hl7_import(mock_get_master_subject_code, mock_get_subject_by_master_code, MockMultipartEncoder):
+def test_hl7_import(mock_get_master_subject_code, MockSubjectIndex, MockMultipartEncoder):
     mock_hc_api = mock.Mock()
     msg = run.HL7Message(HL7_MESSAGE)
     assert msg
     mock_get_master_subject_code.return_value = 'H3B125'
-    mock_get_subject_by_master_code.return_value = None
+    MockSubjectIndex.return_value.get.return_value = None
     mock_hc_api.hl7V2Stores.messages.get.return_value = HL7_MESSAGE
     mock_api = mock.Mock()
     mock_api.post.return_value = mock.Mock()
@@ -124,39 +138,101 @@ def test_hl7_import(mock_get_master_subject_code, mock_get_subject_by_master_cod
     mock_hc_api.hl7V2Stores.messages.get.assert_called_once_with(name='hc_hl7store/messages/sXiWf0k3rtURTkhi7144lsgfWgbP41OG-3fv5zvjLtM=')
     
     # Extract fields from MultipartEncoder's args
-    fields = MockMultipartEncoder.call_args_list[0][1]['fields']
+    fields = dict(MockMultipartEncoder.call_args_list[0][1]['fields'])
     assert fields['file'] == (msg.msg_control_id + '.hl7.txt', base64.b64decode(HL7_MESSAGE['data']))
 
     mock_api.post.assert_called_once()
 
 @mock.patch('run.MultipartEncoder')
-@mock.patch('run.get_subject_by_master_code')
+@mock.patch('run.SubjectIndex')
 @mock.patch('run.get_master_subject_code')
-def test_fhir_import(mock_get_master_subject_code, mock_get_subject_by_master_code, MockMultipartEncoder):
+def test_fhir_import(mock_get_master_subject_code, MockSubjectIndex, MockMultipartEncoder):
     mock_hc_api = mock.Mock()
-    mock_hc_api.fhirStores.fhir.read.side_effect = [FHIR_RESOURCE_OBSERVATION, FHIR_RESOURCE_PATIENT]
+    mock_hc_api.fhirStores.fhir.executeBundle.side_effect = [
+        {'resourceType': 'Bundle', 'type': 'batch-response',
+         'entry': [{'resource': FHIR_RESOURCE_OBSERVATION, 'response': {'status': '200 OK'}}]},
+        {'resourceType': 'Bundle', 'type': 'batch-response',
+         'entry': [{'resource': FHIR_RESOURCE_PATIENT, 'response': {'status': '200 OK'}}]},
+    ]
     mock_get_master_subject_code.return_value = 'H3B125'
-    mock_get_subject_by_master_code.return_value = None
+    MockSubjectIndex.return_value.get.return_value = None
     mock_api = mock.Mock()
     mock_api.post.return_value = mock.Mock()
     run.import_fhir_resources(mock_hc_api, 'hc_fhirstore', IMPORT_IDS['fhirs'], mock_api, PROJECT)
     
     # Extract fields and metadata from MultipartEncoder's args
-    fields = MockMultipartEncoder.call_args_list[0][1]['fields']
-    assert fields['file'] == ('patient.fhir.json', json.dumps(FHIR_RESOURCE_OBSERVATION, sort_keys=True, 
-                                                              indent=4, default=run.metadata_encoder))
+    fields = dict(MockMultipartEncoder.call_args_list[0][1]['fields'])
+    assert fields['file'] == ('patient.fhir.json', json.dumps(FHIR_RESOURCE_OBSERVATION, sort_keys=True,
+                                                              indent=4, default=run.metadata_encoder).encode('utf-8'))
 
 
     mock_api.post.assert_called_once()
+    bundles = [call[1]['body'] for call in mock_hc_api.fhirStores.fhir.executeBundle.call_args_list]
+    assert bundles[0]['entry'] == [{'request': {'method': 'GET', 'url': IMPORT_IDS['fhirs'][0]}}]
+    assert bundles[1]['entry'] == [{'request': {'method': 'GET', 'url': 'Patient/be3dce00-0210-4b83-8a00-d479881c821d'}}]
+    mock_hc_api.fhirStores.fhir.read.assert_not_called()
 
+    # resources that are gone or have no patient are skipped, ones that failed transiently are failed
+    journal = run.ImportJournal()
+    mock_hc_api.fhirStores.fhir.executeBundle.side_effect = [{'entry': [
+        {'response': {'status': '404 Not Found'}},
+        {'resource': dict(FHIR_RESOURCE_OBSERVATION, id='o2', subject={}), 'response': {'status': '200 OK'}},
+        {'response': {'status': '503 Service Unavailable'}}]}]
+    resp = requests.Response()
+    resp.status_code = 503
+    mock_hc_api.fhirStores.fhir.read.side_effect = requests.HTTPError(response=resp)
+    with mock.patch('time.sleep'):
+        run.import_fhir_resources(mock_hc_api, 'hc_fhirstore', ['Observation/o1', 'Observation/o2', 'Observation/o3'],
+                                  mock_api, PROJECT, journal=journal)
+    assert journal.skipped['fhir'] == {'Observation/o1', 'Observation/o2'}
+    assert journal.failed['fhir'] == {'Observation/o3'}
+    assert journal.get_failed('fhir') == 1
+    mock_api.post.assert_called_once()
+
+
+@mock.patch('run.MultipartEncoder')
+@mock.patch('run.SubjectIndex')
+@mock.patch('run.get_master_subject_code')
+def test_fhir_import_dangling_patient(mock_get_master_subject_code, MockSubjectIndex, MockMultipartEncoder):
+    dangling = dict(FHIR_RESOURCE_OBSERVATION, id='o2', subject={'reference': 'Patient/deleted'})
+    mock_hc_api = mock.Mock()
+    mock_hc_api.fhirStores.fhir.executeBundle.side_effect = [
+        {'entry': [{'resource': FHIR_RESOURCE_OBSERVATION, 'response': {'status': '200 OK'}},
+                   {'resource': dangling, 'response': {'status': '200 OK'}}]},
+        {'entry': [{'resource': FHIR_RESOURCE_PATIENT, 'response': {'status': '200 OK'}},
+                   {'response': {'status': '404 Not Found'}}]},
+    ]
+    mock_get_master_subject_code.return_value = 'H3B125'
+    MockSubjectIndex.return_value.get.return_value = None
+    mock_api = mock.Mock()
+    journal = run.ImportJournal()
+    refs = ['Observation/' + FHIR_RESOURCE_OBSERVATION['id'], 'Observation/o2']
+    run.import_fhir_resources(mock_hc_api, 'hc_fhirstore', refs, mock_api, PROJECT, journal=journal)
+    # the valid resource is uploaded, the one of the unreadable patient is skipped
+    mock_api.post.assert_called_once()
+    assert journal.is_done('fhir', refs[0])
+    assert journal.skipped['fhir'] == {'Observation/o2'} and not journal.failed['fhir']
+    mock_hc_api.fhirStores.fhir.read.assert_not_called()
+
+    resp = requests.Response()
+    resp.status_code = 404
+    mock_hc_api.fhirStores.fhir.read.side_effect = requests.HTTPError(response=resp)
+    patients = run.FHIRPatientCache(mock_hc_api, 'hc_fhirstore')
+    assert patients.get('deleted') is None and patients.get('deleted') is None
+    mock_hc_api.fhirStores.fhir.read.assert_called_once()
+    assert not patients.failed_transiently('deleted')
+
+@mock.patch('run.ImportJournal')
 @mock.patch('run.import_hl7_messages')
 @mock.patch('run.import_fhir_resources')
 @mock.patch('run.import_dicom_files')
 @mock.patch('run.HealthcareAPIClient')
 @mock.patch('run.FwApi')
-def test_main(MockFwApi, MockHcApi, mock_import_dicom_files, mock_import_fhir_resources, mock_import_hl7_messages):
+def test_main(MockFwApi, MockHcApi, mock_import_dicom_files, mock_import_fhir_resources, mock_import_hl7_messages,
+              MockImportJournal):
     mock_context = mock.Mock()
-    mock_context.configure_mock(config=CONFIG)
+    mock_context.configure_mock(config=CONFIG, output_dir='/flywheel/v0/output')
+    mock_context.get_input_path.return_value = None
     mock_context.get_input.return_value = {'key': 'docker.local.flywheel.io'}
     mock_context.open_input.return_value.__enter__ = lambda *args: StringIO(json.dumps(IMPORT_IDS))
     mock_context.open_input.return_value.__exit__ = lambda *args: None
@@ -173,12 +249,28 @@ def test_main(MockFwApi, MockHcApi, mock_import_dicom_files, mock_import_fhir_re
 
     with mock.patch('builtins.open', mock.mock_open(read_data=''), create=True) as mock_builtin_open:
         run.main(mock_context)
-    mock_import_dicom_files.assert_called_once_with(hc_api, CONFIG['hc_dicomstore'], IMPORT_IDS['dicoms'],
-                                                    fw_api, PROJECT, False)
-    mock_import_fhir_resources.assert_called_once_with(hc_api, CONFIG['hc_fhirstore'], IMPORT_IDS['fhirs'],
-                                                       fw_api, PROJECT)
-    mock_import_hl7_messages.assert_called_once_with(hc_api, CONFIG['hc_hl7store'], IMPORT_IDS['hl7s'],
-                                                     fw_api, PROJECT)
+    MockImportJournal.assert_called_once_with('/flywheel/v0/output/import_journal.jsonl', resume_path=None)
+    journal = MockImportJournal.return_value
+    journal.close.assert_called_once()
+    mock_import_dicom_files.assert_called_once_with(hc_api, CONFIG['hc_dicomstore'], mock.ANY,
+                                                    fw_api, PROJECT, False, subjects=mock.ANY, master_codes=mock.ANY,
+                                                    config=CONFIG, journal=journal, imported=None, shard=mock.ANY)
+    mock_import_fhir_resources.assert_called_once_with(hc_api, CONFIG['hc_fhirstore'], mock.ANY,
+                                                       fw_api, PROJECT, subjects=mock.ANY, master_codes=mock.ANY,
+                                                       config=CONFIG, journal=journal, imported=None, shard=mock.ANY)
+    mock_import_hl7_messages.assert_called_once_with(hc_api, CONFIG['hc_hl7store'], mock.ANY,
+                                                     fw_api, PROJECT, subjects=mock.ANY, master_codes=mock.ANY,
+                                                     config=CONFIG, journal=journal, imported=None, shard=mock.ANY)
+    assert list(mock_import_dicom_files.call_args[0][2]) == IMPORT_IDS['dicoms']
+    assert list(mock_import_fhir_resources.call_args[0][2]) == IMPORT_IDS['fhirs']
+    assert list(mock_import_hl7_messages.call_args[0][2]) == IMPORT_IDS['hl7s']
+
+    MockImportJournal.reset_mock()
+    mock_context.config = dict(CONFIG, dry_run=True)
+    with mock.patch('run.plan_import') as mock_plan_import, mock.patch('builtins.open', mock.mock_open(), create=True):
+        run.main(mock_context)
+    MockImportJournal.assert_called_once_with(None, resume_path=None)
+    mock_plan_import.assert_called_once()
 
 def test_get_metadata():
     expected_meta = {'session':
@@ -201,3 +293,796 @@ def test_get_metadata():
     assert msg
     meta = run.get_metadata(msg)
     assert meta == expected_meta
+
+def test_loinc_index(tmp_path):
+    table_path = str(tmp_path / 'LoincTableCore.csv')
+    with open(table_path, 'w') as f:
+        f.write('"LOINC_NUM","COMPONENT","SHORTNAME"\n'
+                '"15074-8","Glucose","Glucose Bld-sCnc"\n'
+                '"2345-7","Glucose","Glucose SerPl-mCnc"\n')
+    index_path = run.build_loinc_index(table_path, str(tmp_path / 'LoincTableCore.sqlite'))
+    index = run.LoincIndex(index_path)
+    assert index.lookup('15074-8')['SHORTNAME'] == 'Glucose Bld-sCnc'
+    assert index.lookup('2345-7') == {'LOINC_NUM': '2345-7', 'COMPONENT': 'Glucose', 'SHORTNAME': 'Glucose SerPl-mCnc'}
+    assert index.lookup('0000-0') is None
+    assert run.build_loinc_index(table_path, index_path) == index_path  # up to date, not rebuilt
+
+    # sqlite can't create the index in a read-only or missing directory, the temp dir is used instead
+    tempdir = tmp_path / 'tmp'
+    tempdir.mkdir()
+    with mock.patch('run.tempfile.gettempdir', return_value=str(tempdir)):
+        index_path = run.build_loinc_index(table_path, str(tmp_path / 'missing' / 'LoincTableCore.sqlite'))
+    assert index_path == str(tempdir / 'LoincTableCore.sqlite')
+    assert run.LoincIndex(index_path).lookup('2345-7')['COMPONENT'] == 'Glucose'
+
+def test_subject_index():
+    mock_api = mock.Mock()
+    mock_api.get.return_value.json.return_value = [
+        {'_id': 's1', 'master_code': 'H3B125', 'project': 'p1', 'code': 'ex1'},
+        {'_id': 's2', 'master_code': 'A1C000', 'project': 'p1'},
+        {'_id': 's3', 'project': 'p1'},
+    ]
+    subjects = run.SubjectIndex(mock_api, {'_id': 'p1', 'label': 'Neuroscience'})
+    with mock.patch('run.METRICS', run.Metrics()) as metrics:
+        assert subjects.get('H3B125', 'hl7')['_id'] == 's1'
+        assert subjects.get('A1C000', 'hl7')['_id'] == 's2'
+        assert subjects.get('Z9Z999', 'fhir') is None
+    stages = metrics.as_dict()
+    assert [(name, stats['count']) for name, stats in stages.items()] == [
+        ('subject_load/hl7', 1), ('subject_lookup/hl7', 2), ('subject_lookup/fhir', 1)]
+    subjects.update('Z9Z999', {'master_code': 'Z9Z999', 'code': 'ex2', 'firstname': None})
+    assert subjects.get('Z9Z999', 'fhir') == {'master_code': 'Z9Z999', 'project': 'p1', 'code': 'ex2'}
+    mock_api.get.assert_called_once_with('projects/p1/subjects')
+
+@mock.patch('run.get_master_subject_code')
+def test_master_code_resolver(mock_get_master_subject_code):
+    mock_get_master_subject_code.side_effect = lambda payload, fw_api: 'code-' + payload['patient_id']
+    resolver = run.MasterCodeResolver(mock.Mock())
+    payloads = [{'patient_id': 'MRN-1', 'use_patient_id': True},
+                {'use_patient_id': True, 'patient_id': 'MRN-1 '},
+                {'patient_id': 'MRN-2', 'use_patient_id': True}]
+    resolver.prefetch(payloads, 'hl7')
+    assert mock_get_master_subject_code.call_count == 2
+    assert [resolver.get(payload, 'hl7') for payload in payloads] == ['code-MRN-1', 'code-MRN-1', 'code-MRN-2']
+    assert mock_get_master_subject_code.call_count == 2
+    assert resolver.get({'patient_id': 'MRN-3', 'use_patient_id': True}, 'hl7') == 'code-MRN-3'
+    # the prefetch resolved the first lookup of each patient, it doesn't make them hits
+    assert (resolver.hits, resolver.misses, resolver.prefetched) == (1, 3, 2)
+
+def test_pipeline():
+    finalized = []
+    pipeline = run.Pipeline([
+        ('double', lambda item: item.append(item[0] * 2), 2),
+        ('fail', lambda item: 1 / (item[0] - 3), 1),
+    ], max_in_flight=2, finalize=finalized.append)
+    with pytest.raises(ZeroDivisionError):
+        pipeline.run([i] for i in range(10))
+    # every item that entered the pipeline is finalized, including the ones dropped after the failure
+    assert len(finalized) == len({id(item) for item in finalized})
+    assert [3, 6] in finalized
+
+    # a failing finalize stops the pipeline without leaving the upstream stages blocked
+    def finalize(item):
+        finalized.append(item)
+        raise ValueError(item[0])
+    del finalized[:]
+    pipeline = run.Pipeline([('double', lambda item: item.append(item[0] * 2), 1),
+                             ('noop', lambda item: None, 1)], max_in_flight=2, finalize=finalize)
+    running = concurrent.futures.ThreadPoolExecutor(max_workers=1).submit(pipeline.run, ([i] for i in range(100)))
+    with pytest.raises(ValueError):
+        running.result(timeout=10)
+    assert len(finalized) < 100 and [0, 0] in finalized
+
+    results = []
+    run.Pipeline([('double', lambda item: item.append(item[0] * 2), 3),
+                  ('collect', results.append, 1)], max_in_flight=4).run([i] for i in range(20))
+    assert sorted(results) == [[i, i * 2] for i in range(20)]
+
+def test_save_multipart_parts(tmp_path):
+    parts = [b'DICM' + bytes(range(256)) * 40, b'\r\n--not-the-boundary\r\n', b'']
+    body = b'preamble\r\n'
+    for part in parts:
+        body += b'--b0undary\r\nContent-Type: application/dicom\r\n\r\n' + part + b'\r\n'
+    body += b'--b0undary--\r\n'
+    for chunk_size in (1, 7, 64, len(body)):
+        outdir = tmp_path / str(chunk_size)
+        outdir.mkdir()
+        chunks = (body[i:i + chunk_size] for i in range(0, len(body), chunk_size))
+        allocated = []
+        paths = list(run.save_multipart_parts(chunks, 'b0undary', str(outdir), allocated.append))
+        assert [open(path, 'rb').read() for path in paths] == parts
+        assert sum(allocated) == sum(len(part) for part in parts)
+
+    assert run.get_multipart_boundary('multipart/related; type="application/dicom"; boundary="b0undary"') == 'b0undary'
+    assert run.get_multipart_boundary('application/json') is None
+    with pytest.raises(ValueError):
+        list(run.save_multipart_parts([body[:200]], 'b0undary', str(tmp_path)))
+
+
+def write_dicom(path, transfer_syntax=pydicom.uid.ExplicitVRLittleEndian, **attrs):
+    ds = pydicom.Dataset()
+    ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    ds.StudyInstanceUID = '1.2.840.113619.2.243.4814948993375131.82665.1495.9395539'
+    ds.SeriesInstanceUID = '1.3.46.670589.11.0.0.11.4.2.0.12098.5.7610.1693289264174240079'
+    ds.PatientID = 'MRN-ZEN3H'
+    ds.PatientName = 'Lastname^Firstname'
+    ds.PatientBirthDate = '19720417'
+    ds.StudyDate = ds.AcquisitionDate = '20180703'
+    ds.StudyTime = ds.AcquisitionTime = '011923'
+    ds.SeriesDescription = 'T1w Structural'
+    for key, value in attrs.items():
+        setattr(ds, key, value)
+    ds.file_meta = pydicom.dataset.FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    save_dicom(path, ds)
+
+
+def save_dicom(fp, ds):
+    # pydicom 2 (the last major version for python 3.7) encodes by the dataset's own flags, pydicom 3 by the
+    # file meta transfer syntax and deprecates the pydicom 2 arguments
+    if int(pydicom.__version__.split('.')[0]) < 3:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = ds.file_meta.TransferSyntaxUID == pydicom.uid.ImplicitVRLittleEndian
+        pydicom.dcmwrite(fp, ds, write_like_original=False)
+    else:
+        pydicom.dcmwrite(fp, ds, enforce_file_format=True)
+
+
+def test_pkg_series(tmp_path):
+    series_dir = tmp_path / 'series'
+    series_dir.mkdir()
+    for i, acq_no in enumerate(['1', '1', '2']):
+        write_dicom(str(series_dir / '1.2.3.{}'.format(i)), SOPInstanceUID='1.2.3.{}'.format(i), AcquisitionNumber=acq_no)
+
+    archives = run.pkg_series(str(series_dir), timezone=run.DEFAULT_TZ, map_key='PatientID')
+
+    assert os.listdir(str(series_dir)) == []
+    assert sorted(archive.filename for archive in archives) == [
+        '1.3.46.670589.11.0.0.11.4.2.0.12098.5.7610.1693289264174240079.dicom.zip',
+        '1.3.46.670589.11.0.0.11.4.2.0.12098.5.7610.1693289264174240079_2.dicom.zip']
+    archive = sorted(archives, key=lambda archive: archive.filename)[0]
+    assert archive.metadata['patient_id'] == 'MRN-ZEN3H'
+    assert archive.metadata['acquisition']['label'] == 'T1w Structural'
+    with zipfile.ZipFile(archive.path) as zf:
+        arc_name = archive.arc_name
+        assert sorted(zf.namelist()) == [arc_name + '/1.2.3.0.dcm', arc_name + '/1.2.3.1.dcm']
+        assert json.loads(zf.comment.decode('utf-8'))['patient_id'] == 'MRN-ZEN3H'
+        assert zf.testzip() is None
+        assert zf.infolist()[0].date_time[0] == 2018
+
+
+
+def test_pack_series_storage():
+    series = run.DicomSeries('1.2.3', '1.2.3.4')
+    series.storage = run.TempStorage(budget=10 ** 9)
+    series.storage.open(series)
+    series.tempdir = tempfile.TemporaryDirectory()
+    series.series_dir = os.path.join(series.tempdir.name, 'series')
+    os.mkdir(series.series_dir)
+    for i in range(3):
+        write_dicom(os.path.join(series.series_dir, '1.2.3.{}'.format(i)), SOPInstanceUID='1.2.3.{}'.format(i))
+    nbytes = run.get_dir_size(series.tempdir.name)
+    series.storage.allocate(series, nbytes)
+
+    # the archives are allocated before they are written, the allocation follows the disk once packed
+    with mock.patch.object(series.storage, 'allocate', wraps=series.storage.allocate) as mock_allocate:
+        run.pack_series(series)
+    mock_allocate.assert_called_once_with(series, nbytes)
+    assert series.storage.allocated[series] == series.storage.used == run.get_dir_size(series.tempdir.name)
+    series.cleanup()
+    assert series.storage is None
+
+def test_stream_upload(tmp_path):
+    series_dir = tmp_path / 'series'
+    series_dir.mkdir()
+    for i in range(3):
+        write_dicom(str(series_dir / '1.2.3.{}'.format(i)), SOPInstanceUID='1.2.3.{}'.format(i), AcquisitionNumber='1')
+    archive, = run.pkg_series(str(series_dir), stream=True, timezone=run.DEFAULT_TZ, map_key='PatientID')
+    assert not os.path.exists(archive.path)
+
+    body = b''.join(run.iter_multipart_upload('b0undary', '{"acquisition": {}}', archive))
+    metadata_part, file_part = body.split(b'--b0undary')[1:3]
+    assert metadata_part.endswith(b'\r\n\r\n{"acquisition": {}}\r\n')
+    zip_bytes = file_part.split(b'\r\n\r\n', 1)[1][:-len(b'\r\n')]
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zf:
+        assert zf.testzip() is None
+        assert len(zf.namelist()) == 3
+        assert json.loads(zf.comment.decode('utf-8'))['patient_id'] == 'MRN-ZEN3H'
+        assert zf.read(archive.arc_name + '/1.2.3.0.dcm') == open(str(series_dir / '1.2.3.0'), 'rb').read()
+
+    mock_api = mock.Mock()
+    mock_api.post.return_value.status_code = 411
+    uploader = run.ArchiveUploader(mock_api)
+    allocate = mock.Mock()
+    with mock.patch('run.MultipartEncoder'):
+        uploader.upload(archive, '{}', allocate=allocate)
+    assert not uploader.stream
+    assert mock_api.post.call_count == 2
+    allocate.assert_called_once_with(sum(os.path.getsize(str(path)) for path in series_dir.iterdir()))
+    with zipfile.ZipFile(archive.path) as zf:
+        assert zf.testzip() is None
+
+
+@pytest.mark.parametrize('precompress', [False, True])
+@pytest.mark.parametrize('stream', [False, True])
+def test_compression_policy(tmp_path, stream, precompress):
+    series_dir = tmp_path / 'series'
+    series_dir.mkdir()
+    write_dicom(str(series_dir / '1.2.3.0'), SOPInstanceUID='1.2.3.0', ImageComments='x' * 10000)
+    write_dicom(str(series_dir / '1.2.3.1'), transfer_syntax=pydicom.uid.JPEGBaseline8Bit, SOPInstanceUID='1.2.3.1',
+                ImageComments='x' * 10000)
+    sources = {name: open(str(series_dir / name), 'rb').read() for name in os.listdir(str(series_dir))}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor, \
+            mock.patch('run.ZIPFILE_PRECOMPRESS', precompress):
+        # a window smaller than one member still compresses one ahead
+        compressor = run.MemberCompressor(level=9, executor=executor, window_bytes=1024)
+        assert (compressor.executor is not None) == precompress
+        archive, = run.pkg_series(str(series_dir), stream=stream, compressor=compressor,
+                                  timezone=run.DEFAULT_TZ, map_key='PatientID')
+        if stream:
+            archive.save()
+
+    with zipfile.ZipFile(archive.path) as zf:
+        assert zf.testzip() is None
+        infos = {os.path.basename(info.filename)[:-len('.dcm')]: info for info in zf.infolist()}
+        assert infos['1.2.3.0'].compress_type == zipfile.ZIP_DEFLATED
+        assert infos['1.2.3.0'].compress_size < infos['1.2.3.0'].file_size
+        assert infos['1.2.3.1'].compress_type == zipfile.ZIP_STORED
+        for name, info in infos.items():
+            assert zf.read(info) == sources[name]
+            assert info.date_time != (1980, 1, 1, 0, 0, 0)
+
+
+def test_pkg_series_process_pool(tmp_path):
+    def pack(name, parse_executor=None):
+        series_dir = tmp_path / name / 'series'
+        series_dir.mkdir(parents=True)
+        for i, acq_no in enumerate(['2', '1', '1', '2', '3']):
+            write_dicom(str(series_dir / '1.2.3.{}'.format(i)), SOPInstanceUID='1.2.3.{}'.format(i),
+                        AcquisitionNumber=acq_no, AcquisitionTime='01192{}'.format(i))
+        archives = run.pkg_series(str(series_dir), parse_executor=parse_executor, de_identify=True,
+                                  timezone=run.DEFAULT_TZ, map_key='PatientID')
+        result = []
+        for archive in archives:
+            with zipfile.ZipFile(archive.path) as zf:
+                result.append((archive.filename, archive.metadata, zf.comment,
+                               [(info.filename, info.date_time, zf.read(info)) for info in zf.infolist()]))
+        return result
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2, mp_context=run.get_process_context()) as executor:
+        assert pack('pool', executor) == pack('serial')
+
+
+@mock.patch('run.time.sleep')
+def test_prefetch(mock_sleep):
+    attempts = collections.Counter()
+
+    def fetch(item):
+        attempts[item] += 1
+        if item == 3 and attempts[item] == 1:
+            raise requests.ConnectionError('connection reset')
+        if item == 5:
+            raise ValueError('not transient')
+        return item * 2
+
+    fetched = run.prefetch(lambda item: run.retry_call(fetch, item), range(5), workers=3, window=4)
+    assert list(fetched) == [(i, i * 2) for i in range(5)]
+    assert mock_sleep.call_count == 1
+    assert attempts[3] == 2
+
+    response = requests.Response()
+    response.status_code = 503
+    assert not response
+    assert run.is_transient_error(requests.HTTPError(response=response))
+    response.status_code = 404
+    assert not run.is_transient_error(requests.HTTPError(response=response))
+    with pytest.raises(ValueError):
+        list(run.prefetch(lambda item: run.retry_call(fetch, item), [5, 6], workers=2))
+    assert attempts[5] == 1
+
+
+def test_fhir_patient_cache():
+    mock_hc_api = mock.Mock()
+    mock_hc_api.fhirStores.fhir.read.return_value = FHIR_RESOURCE_PATIENT
+    mock_hc_api.fhirStores.fhir.executeBundle.side_effect = ValueError('batch not supported')
+    patients = run.FHIRPatientCache(mock_hc_api, 'hc_fhirstore')
+    patients.prefetch([run.get_fhir_patient_id(FHIR_RESOURCE_OBSERVATION)] * 2)
+    observations = [run.FHIRResource(FHIR_RESOURCE_OBSERVATION, mock_hc_api, 'hc_fhirstore', patients=patients)
+                    for _ in range(3)]
+    assert [obs.patient_id for obs in observations] == ['MRN-ZEN3H'] * 3
+    mock_hc_api.fhirStores.fhir.read.assert_called_once_with(
+        name='hc_fhirstore/fhir/Patient/be3dce00-0210-4b83-8a00-d479881c821d')
+
+
+def test_read_fhir_resources():
+    def execute_bundle(parent, body):
+        entries = []
+        for entry in body['entry']:
+            url = entry['request']['url']
+            if url.endswith('missing'):
+                entries.append({'response': {'status': '404 Not Found'}})
+            elif url.endswith('throttled'):
+                entries.append({'response': {'status': '429 Too Many Requests'}})
+            else:
+                entries.append({'resource': {'id': url}, 'response': {'status': '200 OK'}})
+        return {'resourceType': 'Bundle', 'type': 'batch-response', 'entry': entries}
+
+    mock_hc_api = mock.Mock()
+    mock_hc_api.fhirStores.fhir.executeBundle.side_effect = execute_bundle
+    mock_hc_api.fhirStores.fhir.read.return_value = {'id': 'retried'}
+    refs = ['Observation/1', 'Encounter/1', 'Observation/missing', 'Observation/throttled', 'Encounter/2']
+    assert run.read_fhir_resources(mock_hc_api, 'hc_fhirstore', refs) == [
+        ('Observation/1', {'id': 'Observation/1'}),
+        ('Encounter/1', {'id': 'Encounter/1'}),
+        ('Observation/throttled', {'id': 'retried'}),
+        ('Encounter/2', {'id': 'Encounter/2'}),
+    ]
+    assert mock_hc_api.fhirStores.fhir.executeBundle.call_count == 2
+    mock_hc_api.fhirStores.fhir.read.assert_called_once_with(name='hc_fhirstore/fhir/Observation/throttled')
+
+    # a failed batch falls back to single reads, one failing read doesn't take the others with it
+    def read(name):
+        if name.endswith('missing'):
+            raise requests.HTTPError('404 Not Found')
+        return {'id': name}
+
+    mock_hc_api.fhirStores.fhir.executeBundle.side_effect = requests.HTTPError('400 Bad Request')
+    mock_hc_api.fhirStores.fhir.read.side_effect = read
+    assert run.fhir_read_many(mock_hc_api, 'hc_fhirstore', ['Observation/1', 'Observation/missing']) == {
+        'Observation/1': {'id': 'hc_fhirstore/fhir/Observation/1'}}
+
+    # entries missing from a short response count as failed
+    mock_hc_api.fhirStores.fhir.executeBundle.side_effect = None
+    mock_hc_api.fhirStores.fhir.executeBundle.return_value = {
+        'entry': [{'resource': {'id': '1'}, 'response': {'status': '200 OK'}},
+                  {'response': {'status': '404 Not Found'}}]}
+    errors = {}
+    assert run.fhir_read_many(mock_hc_api, 'hc_fhirstore', ['Observation/1', 'Observation/2', 'Observation/3'],
+                              errors=errors) == {'Observation/1': {'id': '1'}}
+    assert errors == {'Observation/2': False, 'Observation/3': True}
+
+
+def test_search_uids():
+    def search_for_series(search_filters, fields):
+        assert fields == ['StudyInstanceUID', 'SeriesInstanceUID', 'PatientID']
+        uid_field, uid = list(search_filters.items())[0]
+        matches = {
+            ('StudyInstanceUID', 'study'): [('study', 'series1'), ('study', 'series2')],
+            ('SeriesInstanceUID', 'series3'): [('other', 'series3')],
+        }.get((uid_field, uid), [])
+        return [{'0020000D': {'vr': 'UI', 'Value': [study]}, '0020000E': {'vr': 'UI', 'Value': [series]}}
+                for study, series in matches]
+
+    dicomweb = mock.Mock()
+    dicomweb.search_for_series.side_effect = search_for_series
+    assert sorted(run.search_uids(dicomweb, ['study', 'series3', 'study', 'unknown'], workers=3)) == [
+        ('other', 'series3', None), ('study', 'series1', None), ('study', 'series2', None)]
+    searched = sorted((list(call[1]['search_filters'].items())[0]) for call in dicomweb.search_for_series.call_args_list)
+    assert searched == [('SeriesInstanceUID', 'series3'), ('SeriesInstanceUID', 'unknown'),
+                        ('StudyInstanceUID', 'series3'), ('StudyInstanceUID', 'study'), ('StudyInstanceUID', 'unknown')]
+
+
+def test_import_journal(tmp_path):
+    previous_path = str(tmp_path / 'previous.jsonl')
+    with open(previous_path, 'w') as f:
+        f.write('{"type": "hl7", "id": "msg-1"}\n{"type": "fhir", "id": "Observ')
+    path = str(tmp_path / 'import_journal.jsonl')
+    journal = run.ImportJournal(path, resume_path=previous_path)
+    assert journal.is_done('hl7', 'msg-1')
+    assert not journal.is_done('fhir', 'Observation/1')
+    journal.record('dicom', '1.2.3')
+    journal.skip('fhir', 'Observation/gone')
+    journal.fail('fhir', 'Observation/retry')
+    assert journal.get_failed('fhir') == 1
+    journal.close()
+
+    journal = run.ImportJournal(path)
+    assert journal.is_done('hl7', 'msg-1') and journal.is_done('dicom', '1.2.3')
+    assert journal.is_done('fhir', 'Observation/gone') and not journal.is_done('fhir', 'Observation/retry')
+    assert journal.skipped['fhir'] == {'Observation/gone'} and journal.get_failed('fhir') == 0
+    journal.close()
+
+    mock_api = mock.Mock()
+    mock_api.get.return_value.json.return_value = [
+        {'uid': '1.2.4_2', 'files': [{'name': '1.2.4_2.dicom.zip'}]},
+        {'uid': '1.2.6_1', 'info': {run.SERIES_ACQUISITIONS_INFO_KEY: ['1.2.6_1', '1.2.6_2']}},
+        {'uid': '1.2.6_2', 'info': {run.SERIES_ACQUISITIONS_INFO_KEY: ['1.2.6_1', '1.2.6_2']}},
+        {'uid': '1.2.7_1', 'info': {run.SERIES_ACQUISITIONS_INFO_KEY: ['1.2.7_1', '1.2.7_2']}},
+        {'files': [{'name': 'obs-1.fhir.json'}]},
+    ]
+    imported = run.ImportedIndex(mock_api, {'_id': 'p1', 'label': 'Neuroscience'})
+    assert run.is_imported(journal, imported, 'dicom', '1.2.4', series_uid='1.2.4')
+    assert not run.is_imported(journal, imported, 'dicom', '1.2.5', series_uid='1.2.5')
+    assert run.is_imported(journal, imported, 'dicom', '1.2.6', series_uid='1.2.6')
+    # one of the two acquisitions is missing, the series is imported again
+    assert not run.is_imported(journal, imported, 'dicom', '1.2.7', series_uid='1.2.7')
+    assert run.is_imported(journal, imported, 'fhir', 'Observation/obs-1', filename='obs-1.fhir.json')
+    assert journal.is_done('fhir', 'Observation/obs-1')
+    mock_api.get.assert_called_once_with('acquisitions', params={'filter': 'parents.project=p1'})
+
+
+def test_concurrency_limiter():
+    limiter = run.ConcurrencyLimiter(8)
+    with limiter.slot():
+        with limiter.slot():
+            assert (limiter.active, limiter.depth) == (1, 2)
+    assert (limiter.active, limiter.depth) == (0, 0)
+    limiter.feedback(throttled=True)
+    limiter.feedback(throttled=True)  # within the backoff period, counted once
+    assert limiter.limit == 4
+    for _ in range(4):
+        limiter.feedback(throttled=False)
+    assert 4.9 < limiter.limit < 5
+
+
+@mock.patch('time.sleep')
+@mock.patch('requests.adapters.HTTPAdapter.send')
+def test_retry_adapter(mock_send, mock_sleep):
+    def response(status, headers=None):
+        resp = requests.Response()
+        resp.status_code = status
+        resp.headers.update(headers or {})
+        resp._content, resp._content_consumed = b'', True
+        return resp
+
+    mock_send.side_effect = [response(429, {'Retry-After': '7'}), requests.ConnectionError('reset'), response(200)]
+    session = requests.Session()
+    limiter = run.ConcurrencyLimiter(4)
+    session.mount('https://', run.RetryAdapter(limiter))
+    assert session.get('https://flywheel.test/api/projects').status_code == 200
+    assert mock_send.call_count == 3
+    assert mock_sleep.call_args_list[0][0][0] == 7
+    assert limiter.limit < 4
+
+    # bodies that can't be replayed and requests inside retry_call are sent once
+    mock_send.side_effect = [response(503), response(503)]
+    assert session.post('https://flywheel.test/api/upload/uid', data=iter([b'zip'])).status_code == 503
+    with limiter.slot():
+        assert session.get('https://flywheel.test/api/projects').status_code == 503
+    assert mock_send.call_count == 5
+    assert run.is_transient_error(requests.HTTPError(response=response(503)))
+
+
+def test_metrics(tmp_path):
+    metrics = run.Metrics()
+    with metrics.timer('download', 'dicom') as sample:
+        sample.bytes = 2048
+    metrics.record('download', 'dicom', 0.3, nbytes=1024)
+    metrics.record('upload', 'hl7', 400)
+    with pytest.raises(ValueError):
+        with metrics.timer('upload', 'hl7'):
+            raise ValueError('boom')
+    metrics.write(str(tmp_path))
+
+    with open(str(tmp_path / 'metrics.json')) as f:
+        stats = json.load(f)
+    assert (stats['download/dicom']['count'], stats['download/dicom']['bytes']) == (2, 3072)
+    assert stats['download/dicom']['latency_buckets']['0.5'] == 2
+    assert (stats['upload/hl7']['count'], stats['upload/hl7']['errors']) == (1, 1)
+    with open(str(tmp_path / 'metrics.prom')) as f:
+        prom = f.read()
+    assert 'ghc_import_stage_seconds_bucket{stage="upload",modality="hl7",le="300"} 1\n' in prom
+    assert 'ghc_import_stage_seconds_count{stage="upload",modality="hl7"} 2\n' in prom
+    assert 'ghc_import_stage_bytes_total{stage="download",modality="dicom"} 3072\n' in prom
+
+
+def test_temp_storage():
+    storage = run.TempStorage(budget=100)
+    first, second = object(), object()
+    storage.open(first)
+    storage.open(second)
+    storage.reserve(first, 80)
+    reserved = concurrent.futures.ThreadPoolExecutor(max_workers=1).submit(storage.reserve, second, 30)
+    with pytest.raises(concurrent.futures.TimeoutError):
+        reserved.result(timeout=0.1)
+    storage.reserve(first, 40)  # the oldest series is never blocked
+    storage.release(first, 60)
+    reserved.result(timeout=5)
+    assert storage.used == 90
+    storage.close(first)
+    storage.close(second)
+    assert storage.used == 0
+
+    # writes are allocated against the estimate reserved up front, the rest is released once downloaded
+    assert storage.estimate() == 100
+    storage.open(first)
+    storage.reserve(first, 50)
+    storage.allocate(first, 30)
+    assert storage.used == 50
+    storage.allocate(first, 30)  # outgrows the estimate without waiting
+    assert storage.used == 60
+    storage.finish_download(first)
+    assert storage.used == 60 and storage.estimate() == 60
+    storage.resize(first, 45)  # packed
+    storage.allocate(first, 45)  # archive saved for the upload
+    assert storage.used == 90
+    storage.resize(first, 5)  # uploaded
+    assert storage.used == 5
+    storage.close(first)
+    assert storage.used == 0
+    with pytest.raises(Exception, match='Not enough free space'):
+        storage.check_free_space(2 ** 62)
+
+
+@pytest.mark.parametrize('text', [
+    json.dumps(IMPORT_IDS, indent=2),
+    '\n'.join(json.dumps({key: ref}) for key, refs in sorted(IMPORT_IDS.items()) for ref in refs),
+    '{"dicoms": []}\n{"hl7s": ["sXiWf0k3rtURTkhi7144lsgfWgbP41OG-3fv5zvjLtM="], "fhirs": []}\n'
+    '{"dicoms": ["1.2.840.113619.2.243.4560476901969304.96623.9313.6807608"]}\n{}\n'
+    '{"fhirs": "Patient/d879d684-892a-4ba7-c4c0-9b68c481635f"}\n',
+])
+def test_reference_reader(text):
+    for chunk_size in (1, 7, 1024):
+        refs = collections.defaultdict(list)
+        for key, ref in run.ReferenceReader(StringIO(text), chunk_size=chunk_size).iter_references():
+            refs[key].append(ref)
+        assert refs == IMPORT_IDS
+    with pytest.raises(ValueError):
+        list(run.ReferenceReader(StringIO(text[:-3])).iter_references())
+
+
+def test_import_plan(tmp_path):
+    instance = {'00100020': {'vr': 'LO', 'Value': ['MRN-ZEN3H']}, '00080060': {'vr': 'CS', 'Value': ['MR']},
+                '00280010': {'vr': 'US', 'Value': [256]}, '00280011': {'vr': 'US', 'Value': [256]},
+                '00280100': {'vr': 'US', 'Value': [16]}, '00280008': {'vr': 'IS', 'Value': ['2']}}
+    mock_dicomweb = mock.Mock()
+    mock_dicomweb.search_for_series.return_value = [
+        {'0020000D': {'vr': 'UI', 'Value': ['1.2.3']}, '0020000E': {'vr': 'UI', 'Value': ['1.2.3.4']}}]
+    mock_dicomweb.search_for_instances.return_value = [instance] * 3
+    mock_hc_api = mock.Mock()
+    mock_hc_api.dicomStores.dicomWeb.return_value = mock_dicomweb
+    mock_hc_api.hl7V2Stores.messages.get.return_value = HL7_MESSAGE
+
+    plan_path = str(tmp_path / 'import_plan.jsonl')
+    plan = run.ImportPlan(plan_path)
+    run.plan_dicom_files(mock_hc_api, 'hc_dicomstore', ['1.2.3'], plan, {}, run.ImportJournal(), None, run.Shard())
+    run.plan_hl7_messages(mock_hc_api, 'hc_hl7store', IMPORT_IDS['hl7s'], plan, {}, run.ImportJournal(), None,
+                          run.Shard())
+    plan.close()
+
+    with open(plan_path) as f:
+        entries = [json.loads(line) for line in f]
+    assert [(entry['type'], entry['id'], entry['patient_id']) for entry in entries] == [
+        ('dicom', '1.2.3.4', 'MRN-ZEN3H'), ('hl7', IMPORT_IDS['hl7s'][0], 'MRN-ZEN3H')]
+    assert entries[1]['session'] == 'HL7_MRN-ZEN3H_2018-07-10'
+    summary = plan.get_summary()
+    assert summary['dicom']['instances'] == 3
+    assert summary['dicom']['bytes'] == summary['dicom']['estimated_temp_bytes'] == 3 * (256 * 256 * 2 * 2 + 4096)
+    assert summary['hl7']['units'] == 1
+    mock_dicomweb.search_for_instances.assert_called_once_with(
+        '1.2.3', '1.2.3.4', fields=list(run.PLAN_INSTANCE_TAGS), limit=run.PLAN_PAGE_SIZE, offset=0)
+    mock_dicomweb.retrieve_series.assert_not_called()
+
+
+def test_shard(tmp_path):
+    patient_ids = ['MRN-{}'.format(i) for i in range(200)]
+    shards = [run.Shard(index, 3) for index in range(3)]
+    for patient_id in patient_ids:
+        owners = [shard for shard in shards if shard.owns('hl7', patient_id, patient_id)]
+        assert len(owners) == 1
+        assert owners[0].owns('fhir', 'Patient/x', patient_id + ' ')
+    assert sum(shard.counts['hl7']['owned'] for shard in shards) == 200
+    assert all(shard.counts['hl7']['owned'] > 40 for shard in shards)
+    assert run.Shard.get_shard('MRN-1', 3) == int.from_bytes(hashlib.sha1(b'MRN-1').digest()[:8], 'big') % 3
+    journal = run.ImportJournal()
+    journal.record('hl7', 'msg-1')
+    assert run.is_imported(journal, None, 'hl7', 'msg-1', shard=shards[1])
+    shards[1].write(str(tmp_path))
+    with open(str(tmp_path / 'shard_1_report.json')) as f:
+        report = json.load(f)
+    assert not report['completed']
+    assert report['units']['hl7'] == {'owned': shards[1].counts['hl7']['owned'],
+                                      'other_shards': 200 - shards[1].counts['hl7']['owned'], 'resumed': 1}
+    with pytest.raises(Exception, match='Invalid shard'):
+        run.Shard(3, 3)
+
+
+@mock.patch('run.upload_label')
+def test_label_uploader(mock_upload_label):
+    journal = mock.Mock()
+    subjects = mock.Mock()
+    subjects.get.return_value = None
+    uploader = run.LabelUploader(mock.Mock(), 'hl7', subjects, journal, config={'upload_batch_size': 3})
+
+    def get_metadata(session, filename, **subject):
+        return {'session': {'label': session, 'subject': dict(master_code='H3B125', **subject)},
+                'acquisition': {'label': 'HL7', 'files': [{'name': filename, 'type': 'hl7'}]}}
+
+    uploader.add('msg1', get_metadata('ses1', '1.hl7.txt', code='ex1'), '1.hl7.txt', b'1')
+    uploader.add('msg2', get_metadata('ses2', '2.hl7.txt', code='ex9'), '2.hl7.txt', b'2')
+    # conflicting subject fields keep the first value, like sequential uploads would
+    uploader.add('msg3', get_metadata('ses1', '3.hl7.txt', code='ex2', firstname='John'), '3.hl7.txt', b'3')
+    mock_upload_label.assert_not_called()
+    # a second file with the same name flushes the pending batch first
+    uploader.add('msg4', get_metadata('ses1', '1.hl7.txt'), '1.hl7.txt', b'4')
+    assert mock_upload_label.call_count == 1
+    metadata = json.loads(mock_upload_label.call_args[0][1])
+    assert metadata['session']['subject'] == {'master_code': 'H3B125', 'code': 'ex1', 'firstname': 'John'}
+    assert [f['name'] for f in metadata['acquisition']['files']] == ['1.hl7.txt', '3.hl7.txt']
+    assert mock_upload_label.call_args[0][2] == [('1.hl7.txt', b'1'), ('3.hl7.txt', b'3')]
+    assert [c[0][1] for c in journal.record.call_args_list] == ['msg1', 'msg3']
+    subjects.update.assert_called_once_with('H3B125', metadata['session']['subject'])
+
+    # the first upload set the subject code, the other session doesn't overwrite it
+    subjects.get.return_value = {'master_code': 'H3B125', 'code': 'ex1', 'firstname': 'John'}
+    uploader.flush_all()
+    assert json.loads(mock_upload_label.call_args_list[1][0][1])['session']['subject'] == {'master_code': 'H3B125'}
+    assert [c[0][2] for c in mock_upload_label.call_args_list[1:]] == [[('2.hl7.txt', b'2')], [('1.hl7.txt', b'4')]]
+    assert [c[0][1] for c in journal.record.call_args_list] == ['msg1', 'msg3', 'msg2', 'msg4']
+
+    uploader.max_wait = 0
+    uploader.add('msg5', get_metadata('ses3', '5.hl7.txt'), '5.hl7.txt', b'5')
+    assert mock_upload_label.call_count == 4
+    assert not uploader.groups
+
+
+@mock.patch('run.import_fhir_resources')
+@mock.patch('run.import_hl7_messages')
+@mock.patch('run.import_dicom_files')
+@mock.patch('run.search_fhir_changes')
+@mock.patch('run.list_hl7_changes')
+@mock.patch('run.search_dicom_changes')
+@mock.patch('run.HealthcareAPIClient')
+@mock.patch('run.FwApi')
+def test_main_sync(MockFwApi, MockHcApi, mock_search_dicom_changes, mock_list_hl7_changes, mock_search_fhir_changes,
+                   mock_import_dicom_files, mock_import_hl7_messages, mock_import_fhir_resources, tmp_path):
+    mock_context = mock.Mock()
+    mock_context.configure_mock(config=dict(CONFIG, sync=True), output_dir=str(tmp_path))
+    mock_context.get_input_path.return_value = None
+    mock_context.get_input.side_effect = lambda name: {'key': 'example.flywheel.io:key'} if name == 'key' else None
+    fw_api = MockFwApi()
+    project = dict(PROJECT, _id='project')
+    fw_api.get.side_effect = lambda path: (mock.Mock(json=lambda: project) if path == 'projects/Neuroscience'
+                                           else mock.MagicMock())
+    mock_search_dicom_changes.return_value = iter(['1.2.3'])
+    mock_list_hl7_changes.return_value = iter(['msg-1'])
+    mock_search_fhir_changes.return_value = iter(['Observation/o1', 'Observation/o2'])
+
+    def import_fhir_resources(*args, journal, **kwargs):
+        journal.skip('fhir', 'Observation/o1')
+        journal.fail('fhir', 'Observation/o2')
+
+    mock_import_fhir_resources.side_effect = import_fhir_resources
+
+    run.main(mock_context)
+    assert list(mock_import_fhir_resources.call_args[0][2]) == ['Observation/o1', 'Observation/o2']
+    assert mock_import_dicom_files.call_args[1]['imported'] is not None
+    # the FHIR watermark stays where it was, the next sync lists the failed resource again
+    assert fw_api.post.call_count == 2
+    state = fw_api.post.call_args[1]['json']['set']['ghc_import_sync']
+    assert sorted(state) == ['dicoms', 'hl7s']
+
+    # resources that can never be imported are skipped without holding the watermark back
+    fw_api.post.reset_mock()
+    mock_search_fhir_changes.return_value = iter(['Observation/o1'])
+    mock_import_fhir_resources.side_effect = lambda *args, journal, **kwargs: journal.skip('fhir', 'Observation/o1')
+    run.main(mock_context)
+    assert sorted(fw_api.post.call_args[1]['json']['set']['ghc_import_sync']) == ['dicoms', 'fhirs', 'hl7s']
+
+
+def test_search_dicom_changes():
+    dicomweb = mock.Mock()
+    hc_api = mock.Mock()
+    hc_api.dicomStores.dicomWeb.return_value = dicomweb
+    studies = [{'0020000D': {'vr': 'UI', 'Value': ['1.2.{}'.format(i)]}} for i in range(3)]
+    dicomweb.search_for_studies.side_effect = [studies[:2], studies[2:]]
+    with mock.patch('run.SYNC_PAGE_SIZE', 2):
+        assert list(run.search_dicom_changes(hc_api, 'hc_dicomstore', '2020-01-02T03:04:05Z')) == [
+            '1.2.0', '1.2.1', '1.2.2']
+    assert [call[1] for call in dicomweb.search_for_studies.call_args_list] == [
+        {'search_filters': {'StudyDate': '20200102-'}, 'fields': ['StudyInstanceUID'], 'limit': 2, 'offset': offset}
+        for offset in (0, 2)]
+
+    dicomweb.search_for_studies.side_effect = [[]]
+    assert list(run.search_dicom_changes(hc_api, 'hc_dicomstore', None)) == []
+    assert dicomweb.search_for_studies.call_args[1]['search_filters'] == {}
+
+
+def test_sync():
+    fw_api = mock.Mock()
+    project = dict(PROJECT, _id='project', info={'ghc_import_sync': {
+        'hl7s': {'store': 'hc_hl7store', 'watermark': '2020-01-01T00:00:00Z'},
+        'fhirs': {'store': 'old_fhirstore', 'watermark': '2020-01-01T00:00:00Z'}}})
+    sync = run.SyncState(fw_api, project)
+    assert sync.get_watermark('hl7s', 'hc_hl7store') == '2020-01-01T00:00:00Z'
+    assert sync.get_watermark('fhirs', 'hc_fhirstore') is None
+    assert run.SyncState(fw_api, project, run.Shard(1, 2)).get_watermark('hl7s', 'hc_hl7store') is None
+
+    hc_api = mock.Mock()
+    hc_api.hl7V2Stores.messages.list.side_effect = [
+        {'hl7V2Messages': [{'name': 'hc_hl7store/messages/1'}], 'nextPageToken': 'next'},
+        {'hl7V2Messages': [{'name': 'hc_hl7store/messages/2'}]},
+    ]
+    assert list(run.list_hl7_changes(hc_api, 'hc_hl7store', '2020-01-01T00:00:00Z')) == ['1', '2']
+    assert hc_api.hl7V2Stores.messages.list.call_args[1] == {
+        'parent': 'hc_hl7store', 'pageSize': run.SYNC_PAGE_SIZE, 'filter': 'sendTime >= "2020-01-01T00:00:00Z"',
+        'pageToken': 'next'}
+
+    def search_response(resource_type, ids, next_url=None):
+        return {'response': {'status': '200 OK'}, 'resource': {
+            'resourceType': 'Bundle', 'type': 'searchset',
+            'entry': [{'resource': {'resourceType': resource_type, 'id': _id}} for _id in ids],
+            'link': [{'relation': 'next', 'url': next_url}] if next_url else []}}
+
+    hc_api.fhirStores.fhir.executeBundle.side_effect = [
+        {'entry': [search_response('Patient', ['p1'], 'https://hc/v1/hc_fhirstore/fhir/Patient?_page_token=x'),
+                   search_response('Observation', ['o1'])]},
+        {'entry': [search_response('Patient', ['p2'])]},
+    ]
+    refs = list(run.search_fhir_changes(hc_api, 'hc_fhirstore', ['Patient', 'Observation'], '2020-01-01T00:00:00Z'))
+    assert refs == ['Patient/p1', 'Observation/o1', 'Patient/p2']
+    bundles = [call[1]['body'] for call in hc_api.fhirStores.fhir.executeBundle.call_args_list]
+    assert bundles[0]['entry'][1]['request']['url'] == \
+        'Observation?_elements=id&_count={}&_lastUpdated=ge2020-01-01T00:00:00Z'.format(run.SYNC_PAGE_SIZE)
+    assert bundles[1]['entry'] == [{'request': {'method': 'GET', 'url': 'Patient?_page_token=x'}}]
+
+    hc_api.fhirStores.fhir.executeBundle.side_effect = [{'entry': [{'response': {'status': '500'}}]}]
+    with pytest.raises(Exception, match='FHIR search'):
+        list(run.search_fhir_changes(hc_api, 'hc_fhirstore', ['Patient'], None))
+
+    sync.advance('hl7s', 'hc_hl7store', failed=1)
+    sync.advance('fhirs', 'hc_fhirstore')
+    fw_api.post.assert_called_once_with('projects/project/info', json={'set': {'ghc_import_sync': {
+        'hl7s': {'store': 'hc_hl7store', 'watermark': '2020-01-01T00:00:00Z'},
+        'fhirs': {'store': 'hc_fhirstore', 'watermark': sync.started}}}})
+    assert project['info']['ghc_import_sync']['fhirs']['store'] == 'old_fhirstore'
+
+
+def test_metadata_builder():
+    msg = dict(HL7_MESSAGE, data='eA==', labels={'a.b': ['x', {'c.d': 1}]})
+    assert run.normalize_dict_keys(msg, exclude=('data',))['labels'] == {'a_b': ['x', {'c_d': 1}]}
+    assert 'data' not in run.normalize_dict_keys(msg, exclude=('data',))
+
+    class Container:
+        session_label = 'ses'
+
+        def __init__(self):
+            self.subject_code = 'ex1'
+            self.subject_firstname = None
+            self.acquisition_label = 'acq'
+            self.other = 'x'
+
+        @property
+        def subject_lastname(self):
+            return 'Lastname'
+
+    metadata = run.get_metadata(Container())
+    assert metadata == {'session': {'label': 'ses', 'subject': {'code': 'ex1', 'lastname': 'Lastname'}},
+                        'acquisition': {'label': 'acq'}}
+    run.set_upload_containers(metadata, PROJECT, 'H3B125', {'code': 'ex0'}, run.DICOM_SUBJECT_FIELDS)
+    assert metadata['session']['subject'] == {'master_code': 'H3B125', 'lastname': 'Lastname'}
+    assert metadata['project'] == {'label': PROJECT['label']}
+
+    resp = mock.Mock()
+    with mock.patch.object(run.log, 'isEnabledFor', return_value=False):
+        run.log.debug('%s', run.LazyPformat(resp.json))
+    resp.json.assert_not_called()
+    assert str(run.LazyPformat(lambda: {'a': 1})) == "{'a': 1}"
+
+
+def test_fhir_payload():
+    resource = dict(FHIR_RESOURCE_OBSERVATION, note=[{'text': 'x' * 1000}])
+    full = run.FHIRPayload()
+    assert full.get_info(resource) is resource
+    assert json.loads(full.get_body(resource).decode('utf-8')) == resource
+
+    compact = run.FHIRPayload('compact', 'resourceType, id,code,missing')
+    assert compact.get_info(resource) == {'resourceType': 'Observation', 'id': resource['id'],
+                                          'code': resource['code']}
+    body = compact.get_body(resource)
+    assert json.loads(body.decode('utf-8')) == resource
+    assert len(body) < len(full.get_body(resource))
+    with pytest.raises(ValueError, match='Invalid FHIR payload mode'):
+        run.FHIRPayload('pretty')
+
+    assert run.metadata_encoder(datetime.datetime(2020, 1, 2, 3, 4, 5)) == '2020-01-02T03:04:05+00:00'
+
+
+def test_series_wado_url():
+    dicomweb = DICOMwebClient(url='https://hc/v1/dicomWeb', wado_url_prefix='wado')
+    assert run.get_series_wado_url(dicomweb, '1.2', '1.2.3') == dicomweb._get_series_url('wado', '1.2', '1.2.3')
+    assert run.get_series_wado_url(DICOMwebClient(url='https://hc/v1/dicomWeb'), '1.2', '1.2.3') == \
+        'https://hc/v1/dicomWeb/studies/1.2/series/1.2.3'